@@ -27,10 +27,42 @@
 #
 # 3. 自我修复工作流 (Self-Healing Workflow):
 #    - 问题: 单次运行后，失败的任务需要手动重新运行脚本才能重试。
-#    - 解决: 引入【任务内重试】和【API失败惩罚】机制。
+#    - 解决: 引入【任务内重试】和【API熔断器】机制。
 #      - 任务内重试: 失败的任务会被自动放回待办队列末尾，并有最大重试次数限制，防止死循环。
-#      - API失败惩罚: 持续失败的API Key其“失败分”会增加，导致其在智能调度中的优先级急剧下降，
-#        从而被自动“冷落”，让健康的API接管工作。
+#      - API熔断器: 每个Key都有一份随时间衰减的“健康档案”(错误率 + 耗时EWMA)。错误率过高的Key
+#        会被熔断(open)，不再接收任务；冷却期过后进入半开(half-open)状态，用一次只生成1个token
+#        的探测请求验证是否恢复，恢复后立即回到满负荷工作。早期的偶发故障会随时间“淡忘”。
+#
+# 4. 按预期完成时间调度 (Expected-Completion-Time Routing):
+#    - 问题: 旧版的“长期压力”来自开跑前的轮询式虚拟分配，与任务实际在哪个Key上运行无关。
+#    - 解决: 调度器为每个健康的Key估算“如果现在把任务交给它，预计多久能完成”，综合实测耗时、
+#      当前并发争用和近期错误率，总是选择预计最快完成的那个Key。
+#
+# 5. 集中式非阻塞日志 (Centralized Non-Blocking Logging):
+#    - 问题: 几十个进程同时向同一个终端print彩色日志，互相争抢stdout；XeLaTeX的全部输出被
+#      读进内存只为了丢弃，高并发时造成内存尖峰。
+#    - 解决: 所有进程只把日志记录投递到一个队列里，由主进程中唯一的写入线程负责落盘：
+#      每次运行一个滚动日志文件、每个任务一个滚动日志文件，终端只显示调度事件、警告错误和
+#      定期刷新的紧凑状态行。XeLaTeX的输出直接流式写入文件，不再占用内存。
+#
+# 6. 内存盘编译工作区 (RAM-Backed Compile Workspaces):
+#    - 问题: 几十个XeLaTeX同时在主硬盘上读写 .aux/.log/.pdf 和图片副本，大量的fsync和
+#      元数据操作让编译变成了I/O瓶颈。
+#    - 解决: 可选地把每次编译放到内存盘（如 /dev/shm）上的独立工作区中进行，并用总内存预算
+#      控制同时存在的工作区数量；只有最终的PDF、.tex和源PDF副本写入磁盘。启动时以及工作进程
+#      结束时，都会回收遗留的工作区。
+#
+# 7. 容量规划模拟器 (Discrete-Event Capacity Planner):
+#    - 问题: 并发数、启动延迟、调度权重等参数只能拿真实配额反复试错。
+#    - 解决: `python 本脚本.py --simulate` 会在虚拟时钟上运行与真实主循环【相同】的选Key、熔断
+#      和重试函数，按历史运行记录(attempts.jsonl)或参数化模型抽样上传/生成/编译耗时、失败率和
+#      每个Key的限流，对一组参数组合输出预计总耗时、Key利用率和峰值内存，全程不消耗任何配额。
+#
+# 8. Token与配额记账 (Token & Quota Accounting):
+#    - 问题: 没有人知道每个任务消耗了多少token，只能等API报配额错误才发现额度用完。
+#    - 解决: 每次尝试都从 usage_metadata 读取输入/输出token，按任务、Key和整次运行汇总，并记入
+#      跨运行的当日配额台账。派发前按“已用量 + 在途预估”做准入控制：某个Key预算不足就改派给
+#      其他Key，全部不足则暂停派发。运行结束时报告浪费在失败尝试上的token。
 #
 # 最终效果：您只需运行一次脚本，它就会像一个永不放弃的机器人管家一样，持续工作，
 # 自动绕开被限额的API，不断重试可恢复的失败，直到所有任务都真正成功，或者达到最大
@@ -38,6 +70,8 @@
 # ====================================================================================================
 
 import multiprocessing
+import logging
+import logging.handlers
 import sys
 import os
 import shutil
@@ -47,7 +81,20 @@ import time
 import collections
 import queue
 import random
+import argparse
+import heapq
+import itertools
+import json
+import datetime
+import zoneinfo
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+import math
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from googleapiclient import errors as googleapiclient_errors
 
 # --- 1. 全局配置 ---
 
@@ -75,20 +122,135 @@ PROCESS_CREATION_DELAY = 0.5
 # 【新增】每个任务的最大重试次数。防止因永久性错误(如源文件损坏)导致的无限循环。
 MAX_TASK_RETRIES = 3
 
+# 使用的Gemini模型名称。熔断器的探测请求也会用这个模型生成1个token。
+GEMINI_MODEL_NAME = "gemini-1.5-pro-latest"
+
 # --- 智能调度权重 ---
+# 调度器按“预计完成时间”选择Key：预计完成时间 = 实测耗时EWMA × 争用系数 × 错误系数。
 # 通过调整这些权重，可以改变调度策略的倾向性。
-# 即时负载权重：值越高，程序越倾向于将任务分配给当前“无所事事”的Key。
-WEIGHT_ACTIVE_TASKS = 3.0
-# 长期压力权重：值越高，程序越倾向于帮助那些“名下待办任务总数”多的Key分担压力。
-WEIGHT_REMAINING_TASKS = 1.0
-# API失败惩罚权重：这个值应该比较高，一次失败就应该让这个Key的优先级显著降低。
-WEIGHT_FAILURES = 10.0
+# 并发争用权重：Key每多一个活跃任务，其预计耗时按 (活跃数 / 单Key并发上限) × 该权重 比例放大。
+WEIGHT_ACTIVE_TASKS = 1.0
+# 错误惩罚权重：预计耗时按 (1 + 衰减错误率 × 该权重) 放大，用来近似失败重试带来的额外时间。
+WEIGHT_FAILURES = 2.0
+
+# --- API熔断器与健康度配置 ---
+# 错误率的衰减半衰期（秒）。一次失败的影响每过这么久就减半，早期的偶发故障会被逐渐“淡忘”。
+HEALTH_HALF_LIFE = 300.0
+# 耗时EWMA的平滑系数。值越大，越看重最近一次任务的耗时。
+LATENCY_EWMA_ALPHA = 0.3
+# 尚无实测数据时，假定的单任务耗时（秒）。
+DEFAULT_TASK_LATENCY = 180.0
+# 衰减错误率达到该阈值时熔断该Key。
+CIRCUIT_ERROR_THRESHOLD = 0.5
+# 熔断前至少需要积累的(衰减后)样本数，避免一次失败就熔断（1.5 即“近期至少两次结果”）。
+CIRCUIT_MIN_SAMPLES = 1.5
+# 首次熔断的冷却时间（秒）。每次重新熔断冷却时间都翻倍，直到达到上限；
+# 只有真实任务成功后才恢复为初始值，探测成功不会重置。
+CIRCUIT_OPEN_DURATION = 30.0
+CIRCUIT_MAX_OPEN_DURATION = 300.0
+# 探测请求的超时时间（秒）。
+PROBE_TIMEOUT = 30
+# 连续探测失败达到该次数后，该Key被视为彻底失效，不再探测。
+CIRCUIT_MAX_PROBE_FAILURES = 5
+
+# --- 容量规划模拟器配置 ---
+# 用法: python 本脚本.py --simulate
+# 每个工作进程的内存占用（MB），用于估算峰值内存（参见上文关于分页文件的说明）。
+PROCESS_MEMORY_MB = 1024
+# 模拟的任务数量。None 表示与 get_all_tasks() 的任务数相同。
+SIMULATION_TASK_COUNT = None
+# 随机种子。固定种子可以让不同参数组合在相同的随机条件下比较。
+SIMULATION_SEED = 42
+# 没有历史运行记录时使用的参数化模型。耗时按对数正态分布抽样：(中位数秒, sigma)。
+# 如果 LOG_DIR 下存在历史运行的 attempts.jsonl，耗时与失败率会改用实测数据。
+SIMULATION_MODEL = {
+    'upload_seconds': (8.0, 0.5),
+    'generate_seconds': (150.0, 0.4),
+    'compile_seconds': (6.0, 0.3),
+    'probe_seconds': (1.0, 0.3),    # 探测请求（生成1个token）的耗时
+    'key_fault_rate': 0.05,         # 每次尝试发生API层面失败的概率
+    'key_fault_overrides': {},      # 按Key序号单独指定失败率，如 {0: 1.0} 模拟一个失效的Key
+    'compile_failure_rate': 0.10,   # LaTeX编译失败的概率
+    'requests_per_task': 3,         # 每次尝试消耗的API请求数（上传 + 生成）
+    'rate_limit_rpm': 10,           # 每个Key每分钟允许的请求数，超出即被限流
+    'rate_limit_seconds': 2.0,      # 被限流的请求失败所需的时间
+}
+# 参数扫描网格：对所有组合各模拟一次。键必须是本脚本中的全局配置名。
+SIMULATION_SWEEP = {
+    'TARGET_TOTAL_CONCURRENCY': [14, 28],
+    'MAX_CONCURRENCY_PER_KEY': [2, 4],
+    'PROCESS_CREATION_DELAY': [0.5],
+    'WEIGHT_ACTIVE_TASKS': [1.0],
+    'WEIGHT_FAILURES': [2.0],
+}
+
+# 熔断器的三种状态
+CIRCUIT_CLOSED = 'closed'        # 正常：接收任务
+CIRCUIT_OPEN = 'open'            # 熔断：不接收任务，等待冷却
+CIRCUIT_HALF_OPEN = 'half_open'  # 半开：冷却结束，等待探测结果
 
 # --- 路径配置 ---
 CURRENT_WORKING_DIR = Path.cwd()
 BASE_DIR = CURRENT_WORKING_DIR / "结果2"
 OUTPUT_DIR = BASE_DIR / "latex_output_final"
 OUTPUT_DIR.mkdir(exist_ok=True, parents=True) # 确保输出目录存在
+# 日志根目录。每次运行会在其中创建一个以启动时间命名的子目录。
+LOG_DIR = BASE_DIR / "logs"
+
+# --- 日志配置 ---
+# 整次运行的日志文件达到该大小后滚动，保留的旧文件个数。
+RUN_LOG_MAX_BYTES = 20 * 1024 * 1024
+RUN_LOG_BACKUP_COUNT = 5
+# 单个任务的日志文件达到该大小后滚动，保留的旧文件个数。
+TASK_LOG_MAX_BYTES = 2 * 1024 * 1024
+TASK_LOG_BACKUP_COUNT = 1
+# 同时保持打开的任务日志文件数上限。超出时关闭最久未写入的那个，下次写入时再以追加方式打开，
+# 避免任务数成千上万时耗尽文件描述符（常见上限为1024）。
+TASK_LOG_MAX_OPEN_FILES = 64
+# 终端状态行的刷新间隔（秒）。
+STATUS_INTERVAL = 10.0
+
+# --- 编译工作区配置 ---
+# XeLaTeX编译所用工作区的根目录。设为 None 时直接在输出目录中编译（旧行为）。
+# 在Linux上推荐设为内存盘，例如 Path("/dev/shm") / "gemini_latex_workspaces"，
+# 这样 .aux/.log 和拷贝的图片都只存在于内存中，只有最终的PDF、.tex和源PDF会写入磁盘。
+# 启动时会清理该目录下上次运行遗留的工作区，因此每个脚本请使用单独的目录。
+COMPILE_WORKSPACE_ROOT = None
+# 所有工作区合计允许占用的内存上限（字节）。超出时新的编译会排队等待。
+COMPILE_WORKSPACE_BUDGET = 2 * 1024**3
+# 每个工作区在图片之外额外预留的空间（字节），用于 .aux/.log/.pdf 等编译产物。
+COMPILE_WORKSPACE_OVERHEAD = 32 * 1024**2
+# 等待内存预算时的轮询间隔（秒）。
+COMPILE_WORKSPACE_POLL_INTERVAL = 1.0
+# 工作区中记录预留大小的标记文件名。只有带此文件的目录才会被当作工作区清理。
+WORKSPACE_RESERVATION_FILE = ".workspace_reservation"
+
+# --- Token与配额预算 ---
+# 每日预算，None 表示不限制。请设置得略低于实际配额，给在途任务留出余量。
+DAILY_TOKEN_BUDGET_PER_KEY = None     # 每个Key每天的token预算（输入+输出）
+DAILY_REQUEST_BUDGET_PER_KEY = None   # 每个Key每天的生成请求数预算
+DAILY_TOKEN_BUDGET_TOTAL = None       # 所有Key合计每天的token预算
+DAILY_REQUEST_BUDGET_TOTAL = None     # 所有Key合计每天的生成请求数预算
+# 还没有实测数据时，假定每次生成请求消耗的token数（用于为在途任务预留预算）。
+ESTIMATED_TOKENS_PER_REQUEST = 30000
+# 配额重置所在的时区。Gemini API的每日配额在太平洋时间午夜重置（按当地时间，自动处理夏令时）。
+# Windows没有系统时区数据库，需要先 pip install tzdata。
+QUOTA_RESET_TIMEZONE = "America/Los_Angeles"
+# 预算用尽时：True 表示暂停派发、等待配额重置；False 表示停止派发，剩余任务留给下次运行。
+QUOTA_WAIT_FOR_RESET = True
+# 暂停等待配额重置时的轮询间隔（秒）。
+QUOTA_PAUSE_INTERVAL = 60.0
+# 配额台账：跨运行累计当天每个Key的用量（只记录Key的末4位）。
+QUOTA_LEDGER_PATH = LOG_DIR / "quota_ledger.json"
+# 两个脚本共用同一个台账，写入时对该文件加操作系统级的独占锁互斥。锁文件本身一直保留。
+QUOTA_LEDGER_LOCK_PATH = LOG_DIR / "quota_ledger.lock"
+
+# 终端颜色
+COLOR_GREEN = "\033[92m"
+COLOR_YELLOW = "\033[93m"
+COLOR_RED = "\033[91m"
+COLOR_CYAN = "\033[96m"
+COLOR_RESET = "\033[0m"
 
 # --- LaTeX模板与AI指令 ---
 LATEX_PREAMBLE = r"""
@@ -174,6 +336,75 @@ B. 【组件化排版系统】(The Component System)
 现在，请严格遵循以上所有规则，特别是关于组件化系统的各项规定，开始你的工作。你的目标是生成一份单个的、完整的、能够完美编译的LaTeX文档正文。
 """
 
+# --- 编译工作区（内存盘） ---
+
+def directory_size(path):
+    """统计目录下所有文件的总字节数。文件可能正被其他进程删除，忽略这类竞争。"""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+def list_compile_workspaces():
+    """列出工作区根目录下所有由本脚本创建的工作区（带有预留标记文件的子目录）。"""
+    if COMPILE_WORKSPACE_ROOT is None or not COMPILE_WORKSPACE_ROOT.exists():
+        return []
+    return [ws for ws in COMPILE_WORKSPACE_ROOT.iterdir() if (ws / WORKSPACE_RESERVATION_FILE).exists()]
+
+def compile_workspace_usage():
+    """当前所有工作区的内存占用：每个工作区取“实际大小”与“预留大小”中的较大值。"""
+    usage = 0
+    for ws in list_compile_workspaces():
+        try:
+            reserved = int((ws / WORKSPACE_RESERVATION_FILE).read_text())
+        except (OSError, ValueError):
+            reserved = 0
+        usage += max(directory_size(ws), reserved)
+    return usage
+
+def acquire_compile_workspace(task_id, estimate_bytes, lock, log):
+    """
+    在内存盘上为本次编译创建一个工作区。
+    如果所有工作区的总占用加上本次预估会超出预算，就等待其他编译释放空间。
+    当前没有任何工作区时总是放行，保证超大的任务也能执行。
+    """
+    waiting_logged = False
+    while True:
+        with lock:
+            usage = compile_workspace_usage()
+            if usage == 0 or usage + estimate_bytes <= COMPILE_WORKSPACE_BUDGET:
+                workspace = COMPILE_WORKSPACE_ROOT / f"{os.getpid()}_{task_id}"
+                if workspace.exists():
+                    shutil.rmtree(workspace)
+                workspace.mkdir(parents=True)
+                (workspace / WORKSPACE_RESERVATION_FILE).write_text(str(estimate_bytes))
+                return workspace
+        if not waiting_logged:
+            log.info(f"[{task_id}] 编译工作区内存预算已满 ({usage / 1024**2:.0f}MB)，等待空间释放...")
+            waiting_logged = True
+        time.sleep(COMPILE_WORKSPACE_POLL_INTERVAL)
+
+def release_compile_workspace(workspace):
+    """删除工作区，归还内存预算。"""
+    shutil.rmtree(workspace, ignore_errors=True)
+
+def cleanup_process_workspaces(pid):
+    """删除某个（可能已崩溃的）工作进程遗留的所有工作区。"""
+    for ws in list_compile_workspaces():
+        if ws.name.startswith(f"{pid}_"):
+            release_compile_workspace(ws)
+
+def collect_stale_workspaces():
+    """启动时回收上次运行中崩溃进程遗留的工作区，返回回收的个数。"""
+    stale = list_compile_workspaces()
+    for ws in stale:
+        release_compile_workspace(ws)
+    return len(stale)
+
 # --- 核心业务逻辑 ---
 def get_all_tasks():
     """生成所有可能任务的列表。"""
@@ -192,19 +423,27 @@ def get_all_tasks():
             tasks.append(("2025", "2BC", str(q_num), doc_type))
     return tasks
 
-def process_and_render_question(year, exam_type, question_num, doc_type, lock):
-    """处理单个试题的核心函数：API调用、文件保存、LaTeX编译。"""
+def process_and_render_question(year, exam_type, question_num, doc_type, lock, xelatex_log_path=None, attempt_stats=None):
+    """
+    处理单个试题的核心函数：API调用、文件保存、LaTeX编译。
+    XeLaTeX的终端输出会流式写入 xelatex_log_path（默认写在任务输出目录中）。
+    如果传入 attempt_stats 字典，会在其中记录各阶段耗时和token用量，供模拟器与配额记账使用。
+    """
+    if attempt_stats is None:
+        attempt_stats = {}
     question_base_name = f"{year}-{exam_type}_第{question_num}問_{doc_type}"
     task_id = question_base_name 
+    log = logging.LoggerAdapter(logging.getLogger("worker"), {'task_id': task_id})
     question_output_dir = OUTPUT_DIR / question_base_name
     question_output_dir.mkdir(exist_ok=True)
     source_pdf_path = BASE_DIR / f"{question_base_name}.pdf"
     source_folder_path = BASE_DIR / question_base_name
     source_image_dir = source_folder_path / "images"
     if not source_pdf_path.exists():
-        print(f"注意: 源PDF文件未找到，跳过任务 -> {source_pdf_path}", flush=True)
+        log.warning(f"注意: 源PDF文件未找到，跳过任务 -> {source_pdf_path}")
         return True 
     try:
+        phase_start = time.time()
         prompt_parts = [ai_prompt]
         prompt_parts.append(genai.upload_file(path=source_pdf_path))
         if source_folder_path.exists() and source_image_dir.exists():
@@ -214,222 +453,1034 @@ def process_and_render_question(year, exam_type, question_num, doc_type, lock):
                 prompt_parts.append(image_list_prompt)
                 for image_path in image_files:
                     prompt_parts.append(genai.upload_file(path=image_path))
-        print(f"[{task_id}] 正在调用Gemini模型...", flush=True)
-        model = genai.GenerativeModel(model_name="gemini-1.5-pro-latest")
+        attempt_stats['upload_seconds'] = time.time() - phase_start
+        log.info(f"[{task_id}] 正在调用Gemini模型...")
+        phase_start = time.time()
+        model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
+        # 请求一旦发出就计入配额，即使随后失败
+        attempt_stats['requests'] = attempt_stats.get('requests', 0) + 1
         response = model.generate_content(prompt_parts, request_options={"timeout": 600})
+        record_response_usage(response, attempt_stats)
+        attempt_stats['generate_seconds'] = time.time() - phase_start
         raw_text = response.text.strip()
         if raw_text.startswith("```latex"): raw_text = raw_text[len("```latex"):].strip()
         if raw_text.endswith("```"): raw_text = raw_text[:-len("```")].strip()
         final_latex_code = LATEX_PREAMBLE + "\n" + raw_text
         output_tex_path = question_output_dir / "generated.tex"
         with open(output_tex_path, "w", encoding="utf-8") as f: f.write(final_latex_code)
-        print(f"[{task_id}] LaTeX代码已保存到: {output_tex_path}", flush=True)
-        if source_folder_path.exists() and source_image_dir.exists() and any(source_image_dir.iterdir()):
-            target_image_dir = question_output_dir / "images"
-            if target_image_dir.exists(): shutil.rmtree(target_image_dir)
-            shutil.copytree(source_image_dir, target_image_dir)
-        print(f"[{task_id}] 开始自动渲染PDF...", flush=True)
-        for i in range(2):
-            process = subprocess.run(["xelatex", "-interaction=nonstopmode", output_tex_path.name], cwd=question_output_dir, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-            if process.returncode != 0:
-                print(f"\033[91m[{task_id}] 错误: XeLaTeX 编译失败！日志见: {output_tex_path.with_suffix('.log')}\033[0m", flush=True)
+        log.info(f"[{task_id}] LaTeX代码已保存到: {output_tex_path}")
+        # 编译阶段：启用工作区时在内存盘上进行，否则直接在输出目录中进行
+        has_images = source_folder_path.exists() and source_image_dir.exists() and any(source_image_dir.iterdir())
+        if COMPILE_WORKSPACE_ROOT is not None:
+            estimate_bytes = (directory_size(source_image_dir) if has_images else 0) + COMPILE_WORKSPACE_OVERHEAD
+            compile_dir = acquire_compile_workspace(task_id, estimate_bytes, lock, log)
+            shutil.copy(output_tex_path, compile_dir)
+        else:
+            compile_dir = question_output_dir
+        phase_start = time.time()
+        try:
+            if has_images:
+                target_image_dir = compile_dir / "images"
+                if target_image_dir.exists(): shutil.rmtree(target_image_dir)
+                shutil.copytree(source_image_dir, target_image_dir)
+            log.info(f"[{task_id}] 开始自动渲染PDF...")
+            if xelatex_log_path is None:
+                xelatex_log_path = question_output_dir / "xelatex_output.log"
+            for i in range(2):
+                # 输出直接流式写入文件，而不是整块读进内存
+                with open(xelatex_log_path, "ab") as xelatex_log:
+                    process = subprocess.run(["xelatex", "-interaction=nonstopmode", output_tex_path.name], cwd=compile_dir, stdin=subprocess.DEVNULL, stdout=xelatex_log, stderr=subprocess.STDOUT)
+                if process.returncode != 0:
+                    log.error(f"[{task_id}] 错误: XeLaTeX 编译失败！日志见: {xelatex_log_path}")
+                    return False
+            compiled_pdf_path = compile_dir / output_tex_path.with_suffix('.pdf').name
+            if not compiled_pdf_path.exists():
+                log.error(f"[{task_id}] 错误: PDF文件未生成，即使编译命令没有报错。")
                 return False
-        if output_tex_path.with_suffix('.pdf').exists():
+            # 只有最终PDF写入磁盘；源PDF副本是成功标记，必须最后复制
+            if compile_dir != question_output_dir:
+                shutil.copy(compiled_pdf_path, question_output_dir)
             try:
                 shutil.copy(source_pdf_path, question_output_dir)
             except Exception as copy_e:
-                print(f"\033[93m[{task_id}] 警告: 成功渲染PDF，但复制原始PDF失败: {copy_e}\033[0m", flush=True)
+                log.warning(f"[{task_id}] 警告: 成功渲染PDF，但复制原始PDF失败: {copy_e}")
             return True
-        else:
-            print(f"\033[91m[{task_id}] 错误: PDF文件未生成，即使编译命令没有报错。\033[0m", flush=True)
-            return False
+        finally:
+            attempt_stats['compile_seconds'] = time.time() - phase_start
+            if compile_dir != question_output_dir:
+                release_compile_workspace(compile_dir)
     except Exception as e:
-        print(f"\033[91m--- [{task_id}] 处理过程中发生严重错误: {e} ---\033[0m", flush=True)
-        raise # 重新抛出异常，让上层捕获并打印红色日志
+        log.error(f"--- [{task_id}] 处理过程中发生严重错误: {e} ---")
+        raise # 重新抛出异常，让上层捕获并记录红色日志
+
+# --- 集中式日志管线 ---
+
+class ConsoleFormatter(logging.Formatter):
+    """终端格式：按日志级别（或记录自带的color字段）上色。"""
+    LEVEL_COLORS = {logging.WARNING: COLOR_YELLOW, logging.ERROR: COLOR_RED, logging.CRITICAL: COLOR_RED}
+
+    def format(self, record):
+        message = super().format(record)
+        color = getattr(record, 'color', None) or self.LEVEL_COLORS.get(record.levelno)
+        return f"{color}{message}{COLOR_RESET}" if color else message
+
+class TaskFileHandler(logging.Handler):
+    """
+    按记录中的task_id把日志分发到每个任务自己的滚动日志文件。
+    最多同时打开 TASK_LOG_MAX_OPEN_FILES 个文件，按最近写入的顺序淘汰。
+    """
+
+    def __init__(self, task_log_dir):
+        super().__init__()
+        self.task_log_dir = task_log_dir
+        self.task_handlers = collections.OrderedDict()
+
+    def emit(self, record):
+        task_id = getattr(record, 'task_id', None)
+        if task_id is None:
+            return
+        handler = self.task_handlers.get(task_id)
+        if handler is None:
+            while len(self.task_handlers) >= TASK_LOG_MAX_OPEN_FILES:
+                _, oldest = self.task_handlers.popitem(last=False)
+                oldest.close()
+            handler = logging.handlers.RotatingFileHandler(
+                self.task_log_dir / f"{task_id}.log", maxBytes=TASK_LOG_MAX_BYTES,
+                backupCount=TASK_LOG_BACKUP_COUNT, encoding="utf-8")
+            handler.setFormatter(self.formatter)
+            self.task_handlers[task_id] = handler
+        else:
+            self.task_handlers.move_to_end(task_id)
+        handler.emit(record)
+
+    def close(self):
+        for handler in self.task_handlers.values():
+            handler.close()
+        self.task_handlers.clear()
+        super().close()
+
+def is_console_record(record):
+    """终端只显示调度器的事件与状态，以及所有进程的警告和错误。"""
+    return record.name == "scheduler" or record.levelno >= logging.WARNING
+
+def start_log_pipeline(run_log_dir):
+    """
+    在主进程中启动唯一的日志写入线程。
+    返回 (log_queue, listener)：log_queue 传给子进程，listener 在程序结束时 stop()。
+    """
+    task_log_dir = run_log_dir / "tasks"
+    task_log_dir.mkdir(exist_ok=True, parents=True)
+    file_formatter = logging.Formatter("%(asctime)s %(levelname)-7s [%(processName)s %(process)d] %(message)s")
+
+    run_handler = logging.handlers.RotatingFileHandler(
+        run_log_dir / "run.log", maxBytes=RUN_LOG_MAX_BYTES, backupCount=RUN_LOG_BACKUP_COUNT, encoding="utf-8")
+    run_handler.setFormatter(file_formatter)
+    task_handler = TaskFileHandler(task_log_dir)
+    task_handler.setFormatter(file_formatter)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    console_handler.addFilter(is_console_record)
+    console_handler.setFormatter(ConsoleFormatter("%(message)s"))
+
+    log_queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, run_handler, task_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    # 主进程自己的日志也走同一条管线，保证只有一个写入者
+    setup_process_logging(log_queue)
+    return log_queue, listener
+
+def setup_process_logging(log_queue):
+    """让当前进程的所有日志都只投递到队列中（put_nowait，不会阻塞工作进程）。"""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.DEBUG)
+
+# --- API Key 健康度与熔断器 ---
+
+def new_key_health():
+    """为一个API Key创建初始的健康档案。"""
+    return {
+        'active': 0,                # 当前正在该Key上运行的任务数
+        'state': CIRCUIT_CLOSED,    # 熔断器状态
+        'error_weight': 0.0,        # 衰减后的失败次数
+        'sample_weight': 0.0,       # 衰减后的总样本数
+        'latency_ewma': None,       # 成功任务耗时的EWMA（秒）
+        'last_update': time.time(),
+        'open_until': 0.0,          # 熔断冷却结束的时间点
+        'open_duration': CIRCUIT_OPEN_DURATION,
+        'probe_failures': 0,        # 连续探测失败次数
+        'total_failures': 0,        # 累计失败次数（仅用于最终摘要）
+    }
+
+def decay_key_health(status, now):
+    """按半衰期对错误统计做指数衰减，让旧的失败逐渐失去影响力。"""
+    elapsed = max(0.0, now - status['last_update'])
+    factor = 0.5 ** (elapsed / HEALTH_HALF_LIFE)
+    status['error_weight'] *= factor
+    status['sample_weight'] *= factor
+    status['last_update'] = now
+
+def key_error_rate(status):
+    """返回该Key的衰减错误率 (0~1)。"""
+    if status['sample_weight'] <= 0:
+        return 0.0
+    return status['error_weight'] / status['sample_weight']
+
+def open_circuit(status, now):
+    """熔断该Key，并为下一次熔断把冷却时间翻倍。"""
+    status['state'] = CIRCUIT_OPEN
+    status['open_until'] = now + status['open_duration']
+    status['open_duration'] = min(status['open_duration'] * 2, CIRCUIT_MAX_OPEN_DURATION)
+
+def close_circuit(status):
+    """
+    恢复该Key：清空错误统计，让它立即回到满负荷工作。
+    冷却时间保持不变：探测成功不代表真实任务也能成功，如果很快又被熔断，冷却时间继续翻倍。
+    """
+    status['state'] = CIRCUIT_CLOSED
+    status['error_weight'] = 0.0
+    status['sample_weight'] = 0.0
+    status['probe_failures'] = 0
+
+def refresh_circuit_state(status, now):
+    """冷却期结束的熔断Key转入半开状态。彻底失效的Key保持熔断。"""
+    if status['state'] == CIRCUIT_OPEN and now >= status['open_until'] \
+            and status['probe_failures'] < CIRCUIT_MAX_PROBE_FAILURES:
+        status['state'] = CIRCUIT_HALF_OPEN
+
+def is_key_fault(error):
+    """
+    判断一次异常是否算作Key的故障。只有Gemini API返回的错误（限流、配额、鉴权、服务端错误、超时等）
+    才算；本地错误（找不到xelatex、磁盘或内存盘写满、内容被安全拦截导致取不到 response.text）
+    与Key无关，只算任务失败，否则本地环境一出问题，所有健康的Key都会被熔断。
+    API错误来自两套客户端：generate_content 抛出 google.api_core 的异常，而 upload_file 走的是
+    googleapiclient 的discovery客户端，抛出 HttpError。无效、被吊销或被限流的Key通常在上传时就失败。
+    """
+    return isinstance(error, (google_exceptions.GoogleAPIError, googleapiclient_errors.HttpError))
+
+def api_error_status(error):
+    """返回API异常对应的HTTP状态码；不是API异常或没有状态码时返回None。"""
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code
+    if isinstance(error, googleapiclient_errors.HttpError):
+        return getattr(error.resp, 'status', None)
+    return None
+
+def is_rate_limit_error(error):
+    """判断一次异常是否是限流或配额用尽（HTTP 429，对应gRPC的RESOURCE_EXHAUSTED），上传和生成都算。"""
+    status = api_error_status(error)
+    return status is not None and int(status) == 429
+
+def record_key_outcome(status, key_fault, latency, now):
+    """
+    记录一次任务结果。
+    只有API层面的故障(key_fault)才计入错误率；LaTeX编译失败说明Key本身是好的。
+    返回True表示这次结果导致了熔断。
+    """
+    decay_key_health(status, now)
+    status['sample_weight'] += 1.0
+    if key_fault:
+        status['error_weight'] += 1.0
+        status['total_failures'] += 1
+    elif latency is not None:
+        if status['latency_ewma'] is None:
+            status['latency_ewma'] = latency
+        else:
+            status['latency_ewma'] += LATENCY_EWMA_ALPHA * (latency - status['latency_ewma'])
+        # 真实任务成功才说明Key确实可用，此时熔断冷却时间才恢复为初始值
+        status['open_duration'] = CIRCUIT_OPEN_DURATION
+
+    if status['state'] == CIRCUIT_CLOSED:
+        if status['sample_weight'] >= CIRCUIT_MIN_SAMPLES and key_error_rate(status) >= CIRCUIT_ERROR_THRESHOLD:
+            open_circuit(status, now)
+            return True
+    elif not key_fault:
+        # 熔断前派出的任务成功返回，说明Key已经恢复，无需再等探测
+        close_circuit(status)
+    return False
+
+def record_probe_result(status, ok, now):
+    """
+    记录一次探测结果：成功则恢复，失败则以更长的冷却时间重新熔断。
+    探测期间如果已有真实任务成功返回、熔断器已经闭合，迟到的探测结果直接忽略，
+    不能让一次探测失败把刚被证明可用的Key重新熔断。返回False表示结果被忽略。
+    """
+    if status['state'] == CIRCUIT_CLOSED:
+        return False
+    if ok:
+        close_circuit(status)
+    else:
+        status['probe_failures'] += 1
+        open_circuit(status, now)
+    return True
+
+def expected_completion_time(status, now):
+    """估算“如果现在把一个任务交给该Key，预计多少秒后完成”。"""
+    decay_key_health(status, now)
+    latency = status['latency_ewma'] if status['latency_ewma'] is not None else DEFAULT_TASK_LATENCY
+    contention = 1.0 + WEIGHT_ACTIVE_TASKS * status['active'] / MAX_CONCURRENCY_PER_KEY
+    error_penalty = 1.0 + WEIGHT_FAILURES * key_error_rate(status)
+    return latency * contention * error_penalty
+
+# --- Token与配额记账 ---
+
+def new_usage():
+    """
+    一份用量统计：输入/输出token、生成请求数和尝试次数。
+    metered_requests 只统计带回了 usage_metadata 的请求，用来估算每次请求的token数。
+    """
+    return {'input_tokens': 0, 'output_tokens': 0, 'requests': 0, 'metered_requests': 0, 'attempts': 0}
+
+def add_usage(usage, attempt_stats):
+    """把一次尝试的用量累加到统计中。"""
+    usage['input_tokens'] += attempt_stats.get('input_tokens', 0)
+    usage['output_tokens'] += attempt_stats.get('output_tokens', 0)
+    usage['requests'] += attempt_stats.get('requests', 0)
+    usage['metered_requests'] += attempt_stats.get('metered_requests', 0)
+    usage['attempts'] += 1
+
+def usage_tokens(usage):
+    """输入与输出token之和。"""
+    return usage['input_tokens'] + usage['output_tokens']
+
+def record_response_usage(response, attempt_stats):
+    """从Gemini响应的 usage_metadata 中读取token用量。思考token按输出计费，计入输出。"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    attempt_stats['metered_requests'] = attempt_stats.get('metered_requests', 0) + 1
+    attempt_stats['input_tokens'] = getattr(usage, 'prompt_token_count', 0) or 0
+    attempt_stats['output_tokens'] = (getattr(usage, 'candidates_token_count', 0) or 0) + \
+                                     (getattr(usage, 'thoughts_token_count', 0) or 0)
+
+def quota_day(now):
+    """配额按 QUOTA_RESET_TIMEZONE 时区的自然日重置，返回当前配额日。"""
+    return datetime.datetime.fromtimestamp(now, zoneinfo.ZoneInfo(QUOTA_RESET_TIMEZONE)).strftime("%Y-%m-%d")
+
+def read_quota_ledger_file():
+    """读取台账文件，返回 {'day', 'keys'}；文件不存在或已损坏时返回None。"""
+    try:
+        with open(QUOTA_LEDGER_PATH, encoding="utf-8") as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stored, dict) or 'day' not in stored:
+        return None
+    # 旧版本写入的台账缺少后来新增的字段，补齐默认值
+    keys = {key: dict(new_usage(), **usage) for key, usage in stored.get('keys', {}).items()}
+    return {'day': stored['day'], 'keys': keys}
+
+def acquire_quota_ledger_lock():
+    """
+    对台账锁文件加独占锁（Windows用msvcrt，其他系统用fcntl），返回打开的锁文件。
+    锁由操作系统持有，进程崩溃时自动释放，不存在需要清理的遗留锁。
+    """
+    lock_file = open(QUOTA_LEDGER_LOCK_PATH, "a+b")
+    if os.name == 'nt':
+        # msvcrt 的阻塞模式最多只重试10秒，这里改为自己轮询
+        while True:
+            try:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                time.sleep(0.05)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    return lock_file
+
+def release_quota_ledger_lock(lock_file):
+    """释放台账锁并关闭锁文件。"""
+    if os.name == 'nt':
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    lock_file.close()
+
+def load_quota_ledger(now):
+    """
+    读取配额台账。台账跨运行保留，配额日变化后自动清零。
+    keys 是当天所有进程（包括另一个脚本）的累计用量，pending 是本进程还没写入文件的增量。
+    """
+    stored = read_quota_ledger_file()
+    keys = stored['keys'] if stored and stored['day'] == quota_day(now) else {}
+    return {'day': quota_day(now), 'keys': keys, 'pending': {}}
+
+def roll_quota_ledger(ledger, now):
+    """跨过配额重置时刻时清空台账。返回True表示发生了重置。"""
+    if ledger['day'] == quota_day(now):
+        return False
+    ledger['day'] = quota_day(now)
+    ledger['keys'] = {}
+    ledger['pending'] = {}
+    return True
+
+def save_quota_ledger(ledger):
+    """
+    把本进程的用量增量合并进台账文件。两个脚本可能同时运行，所以在文件锁内重新读取文件、
+    只累加增量，而不是用内存中的副本整体覆盖；合并结果同时刷新内存中的台账，让准入控制
+    也能看到另一个脚本的用量。先写临时文件再替换，避免中途崩溃留下损坏的台账。
+    """
+    QUOTA_LEDGER_PATH.parent.mkdir(parents=True, exist_ok=True)
+    lock_file = acquire_quota_ledger_lock()
+    try:
+        stored = read_quota_ledger_file()
+        if stored and stored['day'] > ledger['day']:
+            # 另一个进程已经进入新的配额日，本进程的增量属于已经过去的一天，不再写入
+            ledger['pending'] = {}
+            return
+        keys = stored['keys'] if stored and stored['day'] == ledger['day'] else {}
+        for key, delta in ledger['pending'].items():
+            usage = keys.setdefault(key, new_usage())
+            for field in usage:
+                usage[field] += delta[field]
+        temp_path = QUOTA_LEDGER_PATH.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({'day': ledger['day'], 'keys': keys}, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, QUOTA_LEDGER_PATH)
+    finally:
+        release_quota_ledger_lock(lock_file)
+    ledger['keys'] = keys
+    ledger['pending'] = {}
+
+def record_quota_usage(ledger, api_key, attempt_stats):
+    """把一次尝试的用量记入当天台账，同时记为待写入文件的增量。"""
+    add_usage(ledger['keys'].setdefault(api_key[-4:], new_usage()), attempt_stats)
+    add_usage(ledger['pending'].setdefault(api_key[-4:], new_usage()), attempt_stats)
+
+def estimated_tokens_per_request(usage):
+    """
+    按已有用量估算每次生成请求的token数；还没有数据时使用 ESTIMATED_TOKENS_PER_REQUEST。
+    只用带回了用量的请求做分母：429等报错的请求不返回token数，如果也算进去，配额错误越多估计值
+    反而越低，准入控制就会放行更多任务。
+    """
+    if usage['metered_requests'] == 0:
+        return ESTIMATED_TOKENS_PER_REQUEST
+    return usage_tokens(usage) / usage['metered_requests']
+
+def within_quota_budget(ledger, api_key, key_in_flight, total_in_flight, estimate_tokens):
+    """
+    准入控制：该Key和全局的“今日已用量 + 在途任务的预估用量 + 本次预估”都不能超过预算，
+    这样在配额真正耗尽之前就停止派发，而不是等API报错。
+    """
+    key_usage = ledger['keys'].get(api_key[-4:], new_usage())
+    total = new_usage()
+    for usage in ledger['keys'].values():
+        for field in total:
+            total[field] += usage.get(field, 0)
+    checks = [
+        (DAILY_TOKEN_BUDGET_PER_KEY, usage_tokens(key_usage) + (key_in_flight + 1) * estimate_tokens),
+        (DAILY_REQUEST_BUDGET_PER_KEY, key_usage['requests'] + key_in_flight + 1),
+        (DAILY_TOKEN_BUDGET_TOTAL, usage_tokens(total) + (total_in_flight + 1) * estimate_tokens),
+        (DAILY_REQUEST_BUDGET_TOTAL, total['requests'] + total_in_flight + 1),
+    ]
+    return all(budget is None or needed <= budget for budget, needed in checks)
+
+# --- 调度决策（真实主循环与容量规划模拟器共用） ---
+
+def select_key(key_status, now, allowed_keys=None):
+    """
+    决策模块：在熔断器闭合且未满载的Key中，选择预计完成时间最短的那个。
+    allowed_keys 不为 None 时，只在其中选择（用于配额准入控制）。
+    返回 (key, 预计完成时间)；没有可用的Key时返回 (None, inf)。
+    """
+    candidate_keys = []
+    for key, status in key_status.items():
+        if allowed_keys is not None and key not in allowed_keys:
+            continue
+        if status['state'] == CIRCUIT_CLOSED and status['active'] < MAX_CONCURRENCY_PER_KEY:
+            candidate_keys.append((key, expected_completion_time(status, now)))
+    if not candidate_keys:
+        return None, float('inf')
+    candidate_keys.sort(key=lambda x: x[1])
+    return candidate_keys[0]
+
+def register_task_failure(task_id, task_retry_counts):
+    """记录一次任务失败。返回True表示还可以重试，False表示已达到最大重试次数。"""
+    task_retry_counts[task_id] += 1
+    return task_retry_counts[task_id] < MAX_TASK_RETRIES
+
+def key_is_dead(status):
+    """该Key已连续探测失败到上限，彻底失效，不会再接收任务。"""
+    return status['probe_failures'] >= CIRCUIT_MAX_PROBE_FAILURES
+
+def all_keys_dead(key_status):
+    """所有Key都已彻底失效。"""
+    return all(key_is_dead(s) for s in key_status.values())
+
+# --- 容量规划模拟器 ---
+
+def sample_duration(spec, rng):
+    """按模型抽样一个耗时：列表表示实测值（经验分布），元组表示 (中位数, sigma) 的对数正态分布。"""
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    median, sigma = spec
+    return rng.lognormvariate(math.log(median), sigma)
+
+def load_recorded_model(log_dir):
+    """
+    从历史运行的 attempts.jsonl 中估计模拟参数：耗时直接使用实测值，失败率使用实测比例。
+    返回 (模型, 记录条数)；没有历史记录时返回 (None, 0)。
+    运行被中途杀掉时最后一行可能只写了一半，无法解析的行直接跳过。
+    """
+    records = []
+    for path in sorted(log_dir.glob("*/attempts.jsonl")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    if not records:
+        return None, 0
+    model = dict(SIMULATION_MODEL)
+    for phase in ('upload_seconds', 'generate_seconds', 'compile_seconds'):
+        samples = [r['stats'][phase] for r in records if phase in r['stats']]
+        if samples:
+            model[phase] = samples
+    # 限流由模拟器按 rate_limit_rpm 自行模拟，实测的限流失败不能再算进失败率，否则会重复计算
+    unthrottled = [r for r in records if not r['stats'].get('rate_limited')]
+    if unthrottled:
+        model['key_fault_rate'] = sum(1 for r in unthrottled if r['key_fault']) / len(unthrottled)
+    # 进入编译阶段却没有成功的，就是编译失败
+    compiled = [r for r in records if 'compile_seconds' in r['stats']]
+    if compiled:
+        model['compile_failure_rate'] = sum(1 for r in compiled if not r['success']) / len(compiled)
+    return model, len(records)
+
+def simulate_attempt(now, fault_rate, request_times, model, rng):
+    """
+    模拟一次任务尝试，返回 (key_fault, success, 耗时)。
+    request_times 是该Key最近发出请求的时间点，用于按每分钟请求数模拟限流。
+    """
+    while request_times and request_times[0] <= now - 60:
+        request_times.popleft()
+    if len(request_times) + model['requests_per_task'] > model['rate_limit_rpm']:
+        request_times.append(now)
+        return True, False, model['rate_limit_seconds']
+    request_times.extend([now] * model['requests_per_task'])
+    upload = sample_duration(model['upload_seconds'], rng)
+    generate = sample_duration(model['generate_seconds'], rng)
+    if rng.random() < fault_rate:
+        # API失败可能发生在生成过程中的任意时刻
+        return True, False, upload + generate * rng.random()
+    compile_time = sample_duration(model['compile_seconds'], rng)
+    return False, rng.random() >= model['compile_failure_rate'], upload + generate + compile_time
+
+def simulate_probe(now, fault_rate, request_times, model, rng):
+    """
+    模拟一次熔断探测，返回 (是否通过, 耗时)。
+    真实的探测是一次生成请求，与任务共用该Key的每分钟请求数限额，失败率也与任务相同，
+    所以被限流的Key在模拟中同样无法通过探测。
+    """
+    while request_times and request_times[0] <= now - 60:
+        request_times.popleft()
+    request_times.append(now)
+    if len(request_times) > model['rate_limit_rpm']:
+        return False, model['rate_limit_seconds']
+    return rng.random() >= fault_rate, sample_duration(model['probe_seconds'], rng)
+
+def simulate_run(task_count, model, rng):
+    """
+    在虚拟时钟上跑一次完整的调度，返回统计结果。
+    主循环的结构与真实编排器一一对应，选Key、熔断和重试使用的是完全相同的函数。
+    """
+    key_status = {key: new_key_health() for key in API_KEYS}
+    for status in key_status.values():
+        status['last_update'] = 0.0
+    fault_rates = {key: model['key_fault_overrides'].get(i, model['key_fault_rate']) for i, key in enumerate(API_KEYS)}
+    request_times = {key: collections.deque() for key in API_KEYS}
+    busy_seconds = dict.fromkeys(API_KEYS, 0.0)
+    pending = collections.deque(range(task_count))
+    task_retry_counts = collections.defaultdict(int)
+    events = []  # 最小堆: (完成时间, 序号, 类型, 数据)
+    sequence = itertools.count()
+    probing = set()
+    running = attempts = succeeded = failed = peak_processes = 0
+    now = next_spawn = 0.0
+
+    while pending or running or probing:
+        # A. 维护熔断器：冷却结束的Key发起探测
+        for key, status in key_status.items():
+            refresh_circuit_state(status, now)
+            if status['state'] == CIRCUIT_HALF_OPEN and key not in probing:
+                probing.add(key)
+                ok, duration = simulate_probe(now, fault_rates[key], request_times[key], model, rng)
+                heapq.heappush(events, (now + duration, next(sequence), 'probe', (key, ok)))
+        peak_processes = max(peak_processes, running + len(probing))
+
+        if pending and not running and not probing and all_keys_dead(key_status):
+            failed += len(pending)
+            pending.clear()
+            break
+
+        # B. 分发新任务（平滑启动：两次启动之间至少间隔 PROCESS_CREATION_DELAY）
+        if pending and running < TARGET_TOTAL_CONCURRENCY and now >= next_spawn:
+            best_key, _ = select_key(key_status, now)
+            if best_key:
+                task = pending.popleft()
+                key_fault, success, duration = simulate_attempt(now, fault_rates[best_key], request_times[best_key], model, rng)
+                heapq.heappush(events, (now + duration, next(sequence), 'task', (task, best_key, success, key_fault, now)))
+                key_status[best_key]['active'] += 1
+                running += 1
+                attempts += 1
+                next_spawn = now + PROCESS_CREATION_DELAY
+                continue
+
+        # 推进虚拟时钟：下一个完成事件、下一个可启动时刻或下一个熔断冷却结束时刻
+        wake_times = [events[0][0]] if events else []
+        if pending and running < TARGET_TOTAL_CONCURRENCY and next_spawn > now:
+            wake_times.append(next_spawn)
+        wake_times.extend(s['open_until'] for s in key_status.values()
+                          if s['state'] == CIRCUIT_OPEN and s['open_until'] > now
+                          and s['probe_failures'] < CIRCUIT_MAX_PROBE_FAILURES)
+        if not wake_times:
+            break
+        now = min(wake_times)
+
+        # C/D. 处理所有已到期的探测结果与任务结果
+        while events and events[0][0] <= now:
+            _, _, kind, data = heapq.heappop(events)
+            if kind == 'probe':
+                key, ok = data
+                probing.discard(key)
+                record_probe_result(key_status[key], ok, now)
+                continue
+            task, key, success, key_fault, started = data
+            status = key_status[key]
+            status['active'] -= 1
+            running -= 1
+            busy_seconds[key] += now - started
+            record_key_outcome(status, key_fault, now - started if success else None, now)
+            if success:
+                succeeded += 1
+            elif register_task_failure(task, task_retry_counts):
+                pending.append(task)
+            else:
+                failed += 1
+
+    makespan = now
+    capacity = MAX_CONCURRENCY_PER_KEY * makespan
+    utilisation = {key: busy / capacity if capacity else 0.0 for key, busy in busy_seconds.items()}
+    # 启用内存盘工作区时，编译工作区最多再占用 COMPILE_WORKSPACE_BUDGET 的内存（图片大小未知，按上限计入）
+    workspace_memory_mb = COMPILE_WORKSPACE_BUDGET / 1024**2 if COMPILE_WORKSPACE_ROOT is not None else 0
+    return {
+        'makespan': makespan,
+        'succeeded': succeeded,
+        'failed': failed,
+        'attempts': attempts,
+        'utilisation': utilisation,
+        'peak_processes': peak_processes,
+        'peak_memory_mb': peak_processes * PROCESS_MEMORY_MB + workspace_memory_mb,
+    }
+
+def run_capacity_planner(task_count=None, seed=SIMULATION_SEED):
+    """对 SIMULATION_SWEEP 中的每个参数组合运行一次模拟，并打印对比表。"""
+    if task_count is None:
+        task_count = len(get_all_tasks())
+    model, record_count = load_recorded_model(LOG_DIR)
+    if model is None:
+        model = SIMULATION_MODEL
+        print("模拟模型: 使用 SIMULATION_MODEL 中的参数（未找到历史运行记录）")
+    else:
+        print(f"模拟模型: 使用 {LOG_DIR} 下 {record_count} 条历史尝试记录")
+    print(f"模拟任务数: {task_count}，API Key数: {len(API_KEYS)}，随机种子: {seed}")
+    if COMPILE_WORKSPACE_ROOT is not None:
+        print(f"峰值内存已包含内存盘编译工作区的预算 {COMPILE_WORKSPACE_BUDGET / 1024**3:.1f}GB")
+    print()
+
+    names = list(SIMULATION_SWEEP)
+    print(" | ".join(names) + " | 总耗时 | 成功 | 失败 | 尝试 | Key利用率(平均/最低/最高) | 峰值进程 | 峰值内存")
+    for values in itertools.product(*SIMULATION_SWEEP.values()):
+        # 临时替换全局配置，让共用的调度函数按这组参数工作
+        saved = {name: globals()[name] for name in names}
+        globals().update(zip(names, values))
+        try:
+            result = simulate_run(task_count, model, random.Random(seed))
+        finally:
+            globals().update(saved)
+        util = list(result['utilisation'].values())
+        print(" | ".join(str(v) for v in values) +
+              f" | {result['makespan'] / 3600:.2f}小时 | {result['succeeded']} | {result['failed']} | {result['attempts']}"
+              f" | {sum(util) / len(util):.0%}/{min(util):.0%}/{max(util):.0%}"
+              f" | {result['peak_processes']} | {result['peak_memory_mb'] / 1024:.1f}GB")
 
 # --- 多进程编排器逻辑 ---
 
-def worker_process(task_info, api_key, lock, result_queue):
+def worker_process(task_info, api_key, lock, result_queue, log_queue, run_log_dir):
     """
     每个子进程的入口函数。
     它负责配置环境、调用核心业务逻辑，并向主进程报告最终结果。
     它会将原始的task_info也放入结果队列，以便主进程进行重试。
     """
+    setup_process_logging(log_queue)
     genai.configure(api_key=api_key)
     year, exam_type, q_num, doc_type = task_info
     task_id = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
     pid = os.getpid()
-    print(f"[进程 {pid} | Key ...{api_key[-4:]}] 开始处理任务: {task_id}", flush=True)
+    log = logging.LoggerAdapter(logging.getLogger("worker"), {'task_id': task_id})
+    xelatex_log_path = run_log_dir / "tasks" / f"{task_id}.xelatex.log"
+    log.info(f"[进程 {pid} | Key ...{api_key[-4:]}] 开始处理任务: {task_id}")
+    # 各阶段耗时，随结果一起交给主进程记录到 attempts.jsonl
+    attempt_stats = {}
     try:
-        success = process_and_render_question(year, exam_type, q_num, doc_type, lock)
+        success = process_and_render_question(year, exam_type, q_num, doc_type, lock, xelatex_log_path=xelatex_log_path, attempt_stats=attempt_stats)
         if success:
-            print(f"\033[92m[进程 {pid} | Key ...{api_key[-4:]}] 任务成功: {task_id}\033[0m", flush=True)
-            result_queue.put((task_id, True, api_key, pid, task_info))
+            log.info(f"[进程 {pid} | Key ...{api_key[-4:]}] 任务成功: {task_id}")
+            result_queue.put((task_id, True, api_key, pid, task_info, False, attempt_stats))
         else:
-            print(f"\033[93m[进程 {pid} | Key ...{api_key[-4:]}] 任务失败 (函数返回False): {task_id}\033[0m", flush=True)
-            result_queue.put((task_id, False, api_key, pid, task_info))
+            # 函数返回False是可控失败(通常是LaTeX编译失败)，API本身是正常的
+            log.warning(f"[进程 {pid} | Key ...{api_key[-4:]}] 任务失败 (函数返回False): {task_id}")
+            result_queue.put((task_id, False, api_key, pid, task_info, False, attempt_stats))
+    except Exception as e:
+        key_fault = is_key_fault(e)
+        # 区分限流与其他API故障：模拟器有自己的限流模型，估计失败率时要排除限流
+        attempt_stats['rate_limited'] = is_rate_limit_error(e)
+        error_kind = "API异常" if key_fault else "本地异常"
+        log.error(f"[进程 {pid} | Key ...{api_key[-4:]}] 任务 '{task_id}' 发生严重{error_kind}: {e}")
+        result_queue.put((task_id, False, api_key, pid, task_info, key_fault, attempt_stats))
+
+def probe_worker(api_key, probe_queue, log_queue):
+    """
+    熔断器的探测进程。
+    发起一次只生成1个token的 generate_content 请求，不上传文件。查询模型元数据的请求不经过
+    生成配额，被限流或当日配额已用尽的Key也能通过，所以探测必须走与真实任务相同的生成接口。
+    探测消耗的请求数和token随结果一起交给主进程记入配额台账。
+    """
+    setup_process_logging(log_queue)
+    start = time.time()
+    attempt_stats = {'requests': 1}
+    try:
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
+        response = model.generate_content("ping", generation_config={"max_output_tokens": 1},
+                                          request_options={"timeout": PROBE_TIMEOUT})
+        record_response_usage(response, attempt_stats)
+        probe_queue.put((api_key, True, time.time() - start, attempt_stats))
     except Exception as e:
-        print(f"\033[91m[进程 {pid} | Key ...{api_key[-4:]}] 任务 '{task_id}' 发生严重异常: {e}\033[0m", flush=True)
-        result_queue.put((task_id, False, api_key, pid, task_info))
+        logging.getLogger("worker").error(f"[探测 | Key ...{api_key[-4:]}] 探测失败: {e}")
+        probe_queue.put((api_key, False, time.time() - start, attempt_stats))
 
 
 if __name__ == "__main__":
     # 在Windows和macOS上，'spawn'是更安全的多进程启动方法，能更好地隔离父子进程
     multiprocessing.set_start_method('spawn', force=True)
 
-    # 步骤 1: 准备任务列表 (采用终极状态检测)
-    # -------------------------------------------------
-    print("\n--- 正在准备任务列表 (基于'已复制的源PDF'进行检测) ---")
-    all_possible_tasks = get_all_tasks()
-    tasks_to_run = []
-    completed_count = 0
-    for task in all_possible_tasks:
-        year, exam_type, q_num, doc_type = task
-        task_id_as_dir_name = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
-        source_pdf_filename = f"{task_id_as_dir_name}.pdf"
-        # 这是我们判断任务是否已【完全成功】的唯一标准
-        expected_success_marker_path = OUTPUT_DIR / task_id_as_dir_name / source_pdf_filename
-        if expected_success_marker_path.exists() and expected_success_marker_path.is_file():
-            completed_count += 1
-        else:
-            tasks_to_run.append(task)
+    parser = argparse.ArgumentParser(description="All-in-One 高并发智能编排器")
+    parser.add_argument("--simulate", action="store_true", help="运行容量规划模拟器，不启动进程、不调用API")
+    parser.add_argument("--sim-tasks", type=int, default=SIMULATION_TASK_COUNT, help="模拟的任务数量")
+    parser.add_argument("--sim-seed", type=int, default=SIMULATION_SEED, help="模拟的随机种子")
+    args = parser.parse_args()
+    if args.simulate:
+        run_capacity_planner(args.sim_tasks, args.sim_seed)
+        sys.exit(0)
+
+    # 启动集中式日志管线：本次运行的所有日志都写入 LOG_DIR/<启动时间>/
+    run_log_dir = LOG_DIR / time.strftime("%Y%m%d_%H%M%S")
+    log_queue, log_listener = start_log_pipeline(run_log_dir)
+    logger = logging.getLogger("scheduler")
+
+    # 无论正常结束、Ctrl-C还是异常退出，都要停止日志线程，把队列中剩余的日志（包括最后的错误）写完
+    try:
+        # 回收上次运行中崩溃进程遗留在内存盘上的编译工作区
+        if COMPILE_WORKSPACE_ROOT is not None:
+            COMPILE_WORKSPACE_ROOT.mkdir(parents=True, exist_ok=True)
+            stale_count = collect_stale_workspaces()
+            logger.info(f"编译工作区: {COMPILE_WORKSPACE_ROOT} (预算 {COMPILE_WORKSPACE_BUDGET / 1024**2:.0f}MB)，已回收 {stale_count} 个遗留工作区。")
+
+        # 步骤 1: 准备任务列表 (采用终极状态检测)
+        # -------------------------------------------------
+        logger.info("\n--- 正在准备任务列表 (基于'已复制的源PDF'进行检测) ---")
+        all_possible_tasks = get_all_tasks()
+        tasks_to_run = []
+        completed_count = 0
+        for task in all_possible_tasks:
+            year, exam_type, q_num, doc_type = task
+            task_id_as_dir_name = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
+            source_pdf_filename = f"{task_id_as_dir_name}.pdf"
+            # 这是我们判断任务是否已【完全成功】的唯一标准
+            expected_success_marker_path = OUTPUT_DIR / task_id_as_dir_name / source_pdf_filename
+            if expected_success_marker_path.exists() and expected_success_marker_path.is_file():
+                completed_count += 1
+            else:
+                tasks_to_run.append(task)
     
-    # 使用双端队列(deque)作为任务池，从左侧弹出任务效率更高
-    tasks_to_run_total = collections.deque(tasks_to_run)
-    initial_task_count = len(tasks_to_run_total)
+        # 使用双端队列(deque)作为任务池，从左侧弹出任务效率更高
+        tasks_to_run_total = collections.deque(tasks_to_run)
+        initial_task_count = len(tasks_to_run_total)
     
-    if not tasks_to_run_total:
-        print(f"\033[92m所有任务均已完全成功，无需执行新任务。\033[0m")
-        sys.exit(0)
+        if not tasks_to_run_total:
+            logger.info("所有任务均已完全成功，无需执行新任务。", extra={'color': COLOR_GREEN})
+            sys.exit(0)
         
-    print(f"总计发现 {len(all_possible_tasks)} 个任务，其中 {completed_count} 个已完全成功。")
-    print(f"本次需要处理 {initial_task_count} 个新任务。")
-
-    # 步骤 2: 初始化调度器
-    # -------------------------------------------------
-    manager = multiprocessing.Manager()
-    lock = manager.Lock()
-    result_queue = manager.Queue()
-    # key_status现在包含'failures'计数器，用于API失败惩罚
-    key_status = {key: {'active': 0, 'remaining': 0, 'failures': 0} for key in API_KEYS}
-    # “虚拟分配”：为每个Key计算一个初始的“长期压力”值
-    for i, task in enumerate(tasks_to_run_total):
-        key_for_task = API_KEYS[i % len(API_KEYS)]
-        key_status[key_for_task]['remaining'] += 1
-        
-    print("\n--- 任务初始虚拟分配情况 ---")
-    for key, status in key_status.items():
-        print(f"  - Key ...{key[-4:]}: 待办 {status['remaining']} 个任务")
+        logger.info(f"总计发现 {len(all_possible_tasks)} 个任务，其中 {completed_count} 个已完全成功。")
+        logger.info(f"本次需要处理 {initial_task_count} 个新任务。日志目录: {run_log_dir}")
+
+        # 步骤 2: 初始化调度器
+        # -------------------------------------------------
+        manager = multiprocessing.Manager()
+        lock = manager.Lock()
+        result_queue = manager.Queue()
+        # 探测结果单独走一个队列，不与任务结果混在一起
+        probe_queue = manager.Queue()
+        # 每个Key一份健康档案：衰减错误率、耗时EWMA与熔断器状态
+        key_status = {key: new_key_health() for key in API_KEYS}
+        # 记录每个运行中进程的启动时间，用于测量任务实际耗时: pid -> 启动时间
+        process_start_times = {}
+        # 正在进行的探测进程: api_key -> Process
+        probe_processes = {}
+        # 每次尝试的结果与各阶段耗时，一行一条JSON
+        attempts_file = open(run_log_dir / "attempts.jsonl", "a", encoding="utf-8")
+        # Token用量：按Key、按任务、整次运行，以及浪费在失败尝试上的部分
+        key_usage = collections.defaultdict(new_usage)
+        task_usage = collections.defaultdict(new_usage)
+        task_wasted_usage = collections.defaultdict(new_usage)
+        run_usage = new_usage()
+        wasted_usage = new_usage()
+        # 跨运行的当日配额台账
+        quota_ledger = load_quota_ledger(time.time())
+        quota_paused = False
+        # 因配额不足而留到下次运行的任务
+        deferred_tasks = []
         
-    active_processes = []
-    successful_tasks = set()
-    permanently_failed_tasks = set()
-    # 用于跟踪每个任务的重试次数
-    task_retry_counts = collections.defaultdict(int)
+        active_processes = []
+        successful_tasks = set()
+        permanently_failed_tasks = set()
+        # 用于跟踪每个任务的重试次数
+        task_retry_counts = collections.defaultdict(int)
+        last_status_time = 0.0
     
-    print(f"\n--- 开始高级调度（自我修复模式），目标并发数: {TARGET_TOTAL_CONCURRENCY} ---")
+        logger.info(f"\n--- 开始高级调度（自我修复模式），目标并发数: {TARGET_TOTAL_CONCURRENCY} ---")
 
-    # 步骤 3: 智能编排器主循环
-    # -------------------------------------------------
-    # 循环条件：只要任务队列中还有任务，或者还有进程在工作，就继续
-    while tasks_to_run_total or active_processes:
-        
-        # A. 尝试分发新任务
-        if tasks_to_run_total and len(active_processes) < TARGET_TOTAL_CONCURRENCY:
-            
-            # 决策模块：基于效能评分选择最佳API Key
-            best_key, min_score = None, float('inf')
-            candidate_keys = []
+        # 步骤 3: 智能编排器主循环
+        # -------------------------------------------------
+        # 循环条件：只要任务队列中还有任务，或者还有进程在工作，就继续
+        while tasks_to_run_total or active_processes:
+            now = time.time()
+
+            # A. 维护熔断器：冷却结束的Key转入半开状态，并为其发起一次探测
             for key, status in key_status.items():
-                if status['active'] < MAX_CONCURRENCY_PER_KEY:
-                    # 评分算法加入失败惩罚，失败越多的Key得分越高，越不容易被选中
-                    score = (status['active'] * WEIGHT_ACTIVE_TASKS) + \
-                            (status['remaining'] * WEIGHT_REMAINING_TASKS) + \
-                            (status['failures'] * WEIGHT_FAILURES)
-                    candidate_keys.append((key, score))
+                refresh_circuit_state(status, now)
+                if status['state'] == CIRCUIT_HALF_OPEN and key not in probe_processes:
+                    probe = multiprocessing.Process(target=probe_worker, args=(key, probe_queue, log_queue))
+                    probe.start()
+                    probe_processes[key] = probe
+                    logger.info(f"[熔断器] Key ...{key[-4:]} 冷却结束，进入半开状态，发起探测 (进程 {probe.pid})。", extra={'color': COLOR_CYAN})
+
+            # 所有Key都已彻底失效：剩余任务无法再执行，全部宣告永久失败
+            if tasks_to_run_total and not active_processes and not probe_processes and all_keys_dead(key_status):
+                logger.error("[调度器] 所有API Key均已彻底失效，剩余任务全部宣告永久失败。")
+                while tasks_to_run_total:
+                    year, exam_type, q_num, doc_type = tasks_to_run_total.popleft()
+                    permanently_failed_tasks.add(f"{year}-{exam_type}_第{q_num}問_{doc_type}")
+                break
+
+            # 配额准入：为在途任务预留预估用量后，仍有预算的Key才能接收新任务。
+            # 彻底失效的Key永远不会再接收任务，不计入准入，否则它会让“预算已用尽”的分支永远不触发
+            if roll_quota_ledger(quota_ledger, now):
+                save_quota_ledger(quota_ledger)
+                logger.info(f"[配额] 已进入新的配额日 {quota_ledger['day']}，每日用量清零。", extra={'color': COLOR_GREEN})
+            estimate_tokens = estimated_tokens_per_request(run_usage)
+            total_in_flight = sum(s['active'] for s in key_status.values())
+            admitted_keys = {key for key, s in key_status.items()
+                             if not key_is_dead(s)
+                             and within_quota_budget(quota_ledger, key, s['active'], total_in_flight, estimate_tokens)}
+            if admitted_keys:
+                quota_paused = False
+            elif tasks_to_run_total and not active_processes:
+                # 没有在途任务会释放预留，说明今日预算确实已经用尽
+                if not QUOTA_WAIT_FOR_RESET:
+                    logger.warning(f"[配额] 今日预算已用尽，停止派发；剩余 {len(tasks_to_run_total)} 个任务留待下次运行。")
+                    while tasks_to_run_total:
+                        year, exam_type, q_num, doc_type = tasks_to_run_total.popleft()
+                        deferred_tasks.append(f"{year}-{exam_type}_第{q_num}問_{doc_type}")
+                    break
+                if not quota_paused:
+                    logger.warning(f"[配额] 今日预算已用尽，暂停派发，等待配额重置 (配额日 {quota_ledger['day']})。")
+                    quota_paused = True
+                time.sleep(QUOTA_PAUSE_INTERVAL)
+                continue
+        
+            # B. 尝试分发新任务
+            if tasks_to_run_total and len(active_processes) < TARGET_TOTAL_CONCURRENCY:
             
-            if candidate_keys:
-                candidate_keys.sort(key=lambda x: x[1])
-                best_key, min_score = candidate_keys[0]
+                # 决策模块：在熔断器闭合且仍有预算的Key中，选择预计完成时间最短的那个
+                best_key, min_score = select_key(key_status, now, admitted_keys)
             
-            # 执行模块：为选中的Key启动一个新进程
-            if best_key:
-                task = tasks_to_run_total.popleft()
-                p = multiprocessing.Process(target=worker_process, args=(task, best_key, lock, result_queue))
-                p.start()
+                # 执行模块：为选中的Key启动一个新进程
+                if best_key:
+                    task = tasks_to_run_total.popleft()
+                    p = multiprocessing.Process(target=worker_process, args=(task, best_key, lock, result_queue, log_queue, run_log_dir))
+                    p.start()
                 
-                # 更新状态记录
-                active_processes.append(p)
-                key_status[best_key]['active'] += 1
+                    # 更新状态记录
+                    active_processes.append(p)
+                    process_start_times[p.pid] = time.time()
+                    key_status[best_key]['active'] += 1
                 
-                print(f"[调度器] 选择 Key ...{best_key[-4:]} (得分: {min_score:.2f}) 启动进程 {p.pid}。总进程: {len(active_processes)}/{TARGET_TOTAL_CONCURRENCY}")
+                    logger.debug(f"[调度器] 选择 Key ...{best_key[-4:]} (预计完成: {min_score:.0f}秒) 启动进程 {p.pid}。总进程: {len(active_processes)}/{TARGET_TOTAL_CONCURRENCY}")
                 
-                # 平滑启动的关键：在启动下一个进程前稍作等待
-                time.sleep(PROCESS_CREATION_DELAY)
+                    # 平滑启动的关键：在启动下一个进程前稍作等待
+                    time.sleep(PROCESS_CREATION_DELAY)
 
-        # B. 尝试从结果队列中收集并处理结果
-        try:
-            # 使用非阻塞的get，避免在队列为空时卡住
-            task_id, success, api_key, pid, task_info = result_queue.get(timeout=0.1)
-            
-            # 释放一个活跃槽位
-            if api_key in key_status:
-                key_status[api_key]['active'] -= 1
+            # C. 收集探测结果
+            while True:
+                try:
+                    api_key, ok, elapsed, probe_stats = probe_queue.get_nowait()
+                except queue.Empty:
+                    break
+                probe = probe_processes.pop(api_key, None)
+                if probe is not None:
+                    probe.join()
+                # 探测请求同样消耗配额，只记入当日台账，不计入任务用量的统计
+                record_quota_usage(quota_ledger, api_key, probe_stats)
+                save_quota_ledger(quota_ledger)
+                status = key_status[api_key]
+                if not record_probe_result(status, ok, time.time()):
+                    logger.debug(f"[熔断器] Key ...{api_key[-4:]} 在探测期间已由真实任务恢复，忽略探测结果。")
+                elif ok:
+                    logger.info(f"[熔断器] Key ...{api_key[-4:]} 探测成功 ({elapsed:.1f}秒)，已恢复满负荷工作。", extra={'color': COLOR_GREEN})
+                elif status['probe_failures'] >= CIRCUIT_MAX_PROBE_FAILURES:
+                    logger.error(f"[熔断器] Key ...{api_key[-4:]} 连续 {status['probe_failures']} 次探测失败，视为彻底失效。")
+                else:
+                    logger.warning(f"[熔断器] Key ...{api_key[-4:]} 探测失败，继续熔断 {status['open_until'] - time.time():.0f} 秒。")
 
-            if success:
-                successful_tasks.add(task_id)
-                # 任务成功，其对应的长期压力也确实减少了
-                if api_key in key_status:
-                    key_status[api_key]['remaining'] -= 1
-            else:
-                # 任务失败处理逻辑：重试或宣告永久失败
+            # 探测进程异常退出而没有回报结果时，视为一次探测失败
+            for key, probe in list(probe_processes.items()):
+                if not probe.is_alive() and probe_queue.empty():
+                    probe_processes.pop(key)
+                    record_probe_result(key_status[key], False, time.time())
+
+            # D. 尝试从结果队列中收集并处理结果
+            try:
+                # 使用非阻塞的get，避免在队列为空时卡住
+                task_id, success, api_key, pid, task_info, key_fault, attempt_stats = result_queue.get(timeout=0.1)
+                finished_at = time.time()
+                start_time = process_start_times.pop(pid, None)
+                latency = finished_at - start_time if start_time is not None else None
+                # 记录本次尝试，供容量规划模拟器复用实测数据（只记录Key的末4位）
+                attempts_file.write(json.dumps({
+                    'task_id': task_id, 'key': api_key[-4:], 'start': start_time, 'end': finished_at,
+                    'success': success, 'key_fault': key_fault, 'stats': attempt_stats,
+                }, ensure_ascii=False) + "\n")
+                attempts_file.flush()
+                # Token记账：按Key、按任务、整次运行，以及当日配额台账
+                add_usage(key_usage[api_key], attempt_stats)
+                add_usage(task_usage[task_id], attempt_stats)
+                add_usage(run_usage, attempt_stats)
+                if not success:
+                    add_usage(wasted_usage, attempt_stats)
+                    add_usage(task_wasted_usage[task_id], attempt_stats)
+                record_quota_usage(quota_ledger, api_key, attempt_stats)
+                save_quota_ledger(quota_ledger)
+            
                 if api_key in key_status:
-                    key_status[api_key]['failures'] += 1 # 增加API的失败计数
-                
-                task_retry_counts[task_id] += 1 # 增加任务的重试计数
-                
-                if task_retry_counts[task_id] < MAX_TASK_RETRIES:
-                    # 未达到最大重试次数，重新放回队列末尾
-                    tasks_to_run_total.append(task_info)
-                    print(f"\033[96m[调度器] 任务 '{task_id}' 失败，已重新排队 (尝试 {task_retry_counts[task_id]}/{MAX_TASK_RETRIES})。API Key ...{api_key[-4:]} 失败计数+1。\033[0m")
+                    status = key_status[api_key]
+                    # 释放一个活跃槽位，并更新该Key的健康档案
+                    status['active'] -= 1
+                    if record_key_outcome(status, key_fault, latency if success else None, finished_at):
+                        logger.error(f"[熔断器] Key ...{api_key[-4:]} 错误率 {key_error_rate(status):.0%}，已熔断 {status['open_until'] - finished_at:.0f} 秒。")
+
+                if success:
+                    successful_tasks.add(task_id)
+                    logger.info(f"[调度器] 任务成功: {task_id} (Key ...{api_key[-4:]})", extra={'color': COLOR_GREEN})
                 else:
-                    # 已达到，宣告永久失败
-                    permanently_failed_tasks.add(task_id)
-                    # 任务永久失败，其对应的长期压力也确实减少了
-                    if api_key in key_status:
-                        key_status[api_key]['remaining'] -= 1
-                    print(f"\033[91m[调度器] 任务 '{task_id}' 已达到最大重试次数，宣告永久失败。\033[0m")
-
-        except queue.Empty:
-            # 队列为空是正常现象，直接进入下一轮循环
-            pass
-
-        # C. 清理已结束的进程
-        active_processes = [p for p in active_processes if p.is_alive()]
+                    # 任务失败处理逻辑：重试或宣告永久失败
+                    if register_task_failure(task_id, task_retry_counts):
+                        # 未达到最大重试次数，重新放回队列末尾
+                        tasks_to_run_total.append(task_info)
+                        logger.info(f"[调度器] 任务 '{task_id}' 失败，已重新排队 (尝试 {task_retry_counts[task_id]}/{MAX_TASK_RETRIES})。", extra={'color': COLOR_CYAN})
+                    else:
+                        # 已达到，宣告永久失败
+                        permanently_failed_tasks.add(task_id)
+                        logger.error(f"[调度器] 任务 '{task_id}' 已达到最大重试次数，宣告永久失败。")
+
+            except queue.Empty:
+                # 队列为空是正常现象，直接进入下一轮循环
+                pass
+
+            # E. 清理已结束的进程（包括异常崩溃的进程遗留的编译工作区）
+            if COMPILE_WORKSPACE_ROOT is not None:
+                for p in active_processes:
+                    if not p.is_alive():
+                        cleanup_process_workspaces(p.pid)
+            active_processes = [p for p in active_processes if p.is_alive()]
+
+            # F. 定期在终端刷新一行紧凑的状态摘要
+            if time.time() - last_status_time >= STATUS_INTERVAL:
+                last_status_time = time.time()
+                open_keys = sum(1 for s in key_status.values() if s['state'] != CIRCUIT_CLOSED)
+                logger.info(f"[状态] 运行中 {len(active_processes)} | 排队 {len(tasks_to_run_total)} | 成功 {len(successful_tasks)} | 永久失败 {len(permanently_failed_tasks)} | 熔断Key {open_keys}/{len(key_status)} | Token {usage_tokens(run_usage)}")
         
-        # 短暂休眠，避免主进程CPU空转
-        time.sleep(0.1)
-
-    # 步骤 4: 最终结果统计
-    # -------------------------------------------------
-    print("\n--- 所有任务处理循环已结束 ---")
-    print("\n" + "="*50)
-    print("           最终任务执行摘要")
-    print("="*50)
-    print(f"\033[92m成功任务数: {len(successful_tasks)}\033[0m")
-    # 失败任务数现在是那些达到最大重试次数的任务
-    print(f"\033[91m永久失败任务数: {len(permanently_failed_tasks)}\033[0m")
-    if permanently_failed_tasks:
-        print("\n永久失败的任务列表 (已达最大重试次数):")
-        for task_id in sorted(list(permanently_failed_tasks)):
-            print(f"  - {task_id}")
-    print("="*50)
+            # 短暂休眠，避免主进程CPU空转
+            time.sleep(0.1)
+
+        # 收尾：等待仍在进行的探测进程结束
+        for probe in probe_processes.values():
+            probe.join()
+        attempts_file.close()
+
+        # 步骤 4: 最终结果统计
+        # -------------------------------------------------
+        logger.info("\n--- 所有任务处理循环已结束 ---")
+        logger.info("\n" + "="*50)
+        logger.info("           最终任务执行摘要")
+        logger.info("="*50)
+        logger.info(f"成功任务数: {len(successful_tasks)}", extra={'color': COLOR_GREEN})
+        # 失败任务数现在是那些达到最大重试次数的任务
+        logger.info(f"永久失败任务数: {len(permanently_failed_tasks)}", extra={'color': COLOR_RED})
+        if permanently_failed_tasks:
+            logger.info("\n永久失败的任务列表 (已达最大重试次数):")
+            for task_id in sorted(list(permanently_failed_tasks)):
+                logger.info(f"  - {task_id}")
+        logger.info("\nAPI Key 健康状况:")
+        for key, status in key_status.items():
+            latency = f"{status['latency_ewma']:.0f}秒" if status['latency_ewma'] is not None else "无数据"
+            logger.info(f"  - Key ...{key[-4:]}: 熔断器 {status['state']}, 累计失败 {status['total_failures']} 次, 平均耗时 {latency}")
+        logger.info("\nToken与配额用量:")
+        for key in API_KEYS:
+            usage = key_usage[key]
+            today = quota_ledger['keys'].get(key[-4:], new_usage())
+            logger.info(f"  - Key ...{key[-4:]}: 输入 {usage['input_tokens']} / 输出 {usage['output_tokens']} tokens, 请求 {usage['requests']} 次 (今日累计 {usage_tokens(today)} tokens, {today['requests']} 次)")
+        wasted_ratio = usage_tokens(wasted_usage) / usage_tokens(run_usage) if usage_tokens(run_usage) else 0.0
+        logger.info(f"  本次合计: {usage_tokens(run_usage)} tokens, {run_usage['requests']} 次请求；其中浪费在失败尝试上 {usage_tokens(wasted_usage)} tokens ({wasted_ratio:.0%})")
+        if successful_tasks:
+            logger.info(f"  平均每个成功任务消耗 {usage_tokens(run_usage) / len(successful_tasks):.0f} tokens")
+        if deferred_tasks:
+            logger.warning(f"  因配额不足留待下次运行的任务数: {len(deferred_tasks)}")
+        # 详细的用量报告（按任务、按Key）写入本次运行的日志目录
+        usage_report_path = run_log_dir / "usage_report.json"
+        with open(usage_report_path, "w", encoding="utf-8") as f:
+            json.dump({
+                'run': run_usage,
+                'wasted': wasted_usage,
+                'keys': {key[-4:]: key_usage[key] for key in API_KEYS},
+                'tasks': {task_id: dict(usage, wasted_tokens=usage_tokens(task_wasted_usage[task_id]))
+                          for task_id, usage in sorted(task_usage.items())},
+                'deferred_tasks': deferred_tasks,
+                'quota_ledger': {'day': quota_ledger['day'], 'keys': quota_ledger['keys']},
+            }, f, ensure_ascii=False, indent=2)
+        logger.info(f"  详细用量报告: {usage_report_path}")
+        logger.info("="*50)
     
-    if not permanently_failed_tasks and initial_task_count > 0:
-        print(f"\033[92m恭喜！所有 {initial_task_count} 个待办任务均已成功完成！\033[0m")
-    elif not permanently_failed_tasks and initial_task_count == 0:
-        print("\033[92m无需执行新任务。\033[0m")
-    else:
-        print(f"\033[93m注意：有 {len(permanently_failed_tasks)} 个任务在达到最大重试次数后仍未成功。\033[0m")
+        if not permanently_failed_tasks and not deferred_tasks and initial_task_count > 0:
+            logger.info(f"恭喜！所有 {initial_task_count} 个待办任务均已成功完成！", extra={'color': COLOR_GREEN})
+        elif not permanently_failed_tasks and not deferred_tasks and initial_task_count == 0:
+            logger.info("无需执行新任务。", extra={'color': COLOR_GREEN})
+        else:
+            if permanently_failed_tasks:
+                logger.warning(f"注意：有 {len(permanently_failed_tasks)} 个任务在达到最大重试次数后仍未成功。")
+            if deferred_tasks:
+                logger.warning(f"注意：有 {len(deferred_tasks)} 个任务因配额不足未执行，下次运行时会自动继续。")
 
-    print("\033[92m--- 程序执行结束 ---\033[0m")
+        logger.info("--- 程序执行结束 ---", extra={'color': COLOR_GREEN})
+    except KeyboardInterrupt:
+        logger.warning("收到中断信号 (Ctrl-C)，程序提前退出。")
+        raise
+    finally:
+        log_listener.stop()
@@ -28,9 +28,23 @@
 #
 # 3. 隔离工作区与成果移交 (Isolated Workspace & Result Promotion):
 #    每个进程在隔离的临时目录中工作。“胜利者”进程负责将自己的成果正式移交到最终的输出目录。
+#
+# 4. 集中式非阻塞日志 (Centralized Non-Blocking Logging):
+#    所有进程只把日志投递到队列，由主进程中唯一的写入线程写入滚动的运行日志和任务日志；
+#    终端只显示调度事件与警告错误。XeLaTeX的输出直接流式写入文件，不再读进内存。
+#
+# 5. 内存盘编译工作区 (RAM-Backed Compile Workspaces):
+#    可选地把XeLaTeX编译放到内存盘（如 /dev/shm）上的独立工作区中，并用总内存预算限制
+#    同时进行的编译；只有最终的PDF、.tex和源PDF副本写入磁盘。启动时回收遗留的工作区。
+#
+# 6. Token与配额记账 (Token & Quota Accounting):
+#    记录每个攻坚进程的token用量，并单独统计浪费在落败和失败尝试上的部分（同一任务每个Key都要付费）。
+#    只有今日预算仍足以覆盖一次尝试的Key才会参战；全部用尽时暂停或把剩余任务留到下次运行。
 # ====================================================================================================
 
 import multiprocessing
+import logging
+import logging.handlers
 import sys
 import os
 import shutil
@@ -40,6 +54,13 @@ import time
 import collections
 import queue
 import random
+import json
+import datetime
+import zoneinfo
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
 import google.generativeai as genai
 
 # --- 1. 全局配置 ---
@@ -52,6 +73,56 @@ CURRENT_WORKING_DIR = Path.cwd()
 BASE_DIR = CURRENT_WORKING_DIR / "结果2"
 OUTPUT_DIR = BASE_DIR / "latex_output_final"
 OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+LOG_DIR = BASE_DIR / "logs"
+
+# --- 日志配置 ---
+RUN_LOG_MAX_BYTES = 20 * 1024 * 1024
+RUN_LOG_BACKUP_COUNT = 5
+TASK_LOG_MAX_BYTES = 2 * 1024 * 1024
+TASK_LOG_BACKUP_COUNT = 1
+# 同时保持打开的任务日志文件数上限。超出时关闭最久未写入的那个，下次写入时再以追加方式打开，
+# 避免任务数成千上万时耗尽文件描述符（常见上限为1024）。
+TASK_LOG_MAX_OPEN_FILES = 64
+
+# --- 编译工作区配置 ---
+# XeLaTeX编译所用工作区的根目录。设为 None 时直接在输出目录中编译（旧行为）。
+# 在Linux上推荐设为内存盘，例如 Path("/dev/shm") / "gemini_latex_assault_workspaces"，
+# 这样 .aux/.log 和拷贝的图片都只存在于内存中，只有最终的PDF、.tex和源PDF会写入磁盘。
+# 启动时会清理该目录下上次运行遗留的工作区，因此每个脚本请使用单独的目录。
+COMPILE_WORKSPACE_ROOT = None
+# 所有工作区合计允许占用的内存上限（字节）。超出时新的编译会排队等待。
+COMPILE_WORKSPACE_BUDGET = 2 * 1024**3
+# 每个工作区在图片之外额外预留的空间（字节），用于 .aux/.log/.pdf 等编译产物。
+COMPILE_WORKSPACE_OVERHEAD = 32 * 1024**2
+# 等待内存预算时的轮询间隔（秒）。
+COMPILE_WORKSPACE_POLL_INTERVAL = 1.0
+# 工作区中记录预留大小的标记文件名。只有带此文件的目录才会被当作工作区清理。
+WORKSPACE_RESERVATION_FILE = ".workspace_reservation"
+
+# --- Token与配额预算 ---
+# 每日预算，None 表示不限制。请设置得略低于实际配额，给在途任务留出余量。
+DAILY_TOKEN_BUDGET_PER_KEY = None     # 每个Key每天的token预算（输入+输出）
+DAILY_REQUEST_BUDGET_PER_KEY = None   # 每个Key每天的生成请求数预算
+DAILY_TOKEN_BUDGET_TOTAL = None       # 所有Key合计每天的token预算
+DAILY_REQUEST_BUDGET_TOTAL = None     # 所有Key合计每天的生成请求数预算
+# 还没有实测数据时，假定每次生成请求消耗的token数（用于为在途任务预留预算）。
+ESTIMATED_TOKENS_PER_REQUEST = 30000
+# 配额重置所在的时区。Gemini API的每日配额在太平洋时间午夜重置（按当地时间，自动处理夏令时）。
+# Windows没有系统时区数据库，需要先 pip install tzdata。
+QUOTA_RESET_TIMEZONE = "America/Los_Angeles"
+# 预算用尽时：True 表示暂停派发、等待配额重置；False 表示停止派发，剩余任务留给下次运行。
+QUOTA_WAIT_FOR_RESET = True
+# 暂停等待配额重置时的轮询间隔（秒）。
+QUOTA_PAUSE_INTERVAL = 60.0
+# 配额台账：跨运行累计当天每个Key的用量（只记录Key的末4位）。
+QUOTA_LEDGER_PATH = LOG_DIR / "quota_ledger.json"
+# 两个脚本共用同一个台账，写入时对该文件加操作系统级的独占锁互斥。锁文件本身一直保留。
+QUOTA_LEDGER_LOCK_PATH = LOG_DIR / "quota_ledger.lock"
+
+COLOR_GREEN = "\033[92m"
+COLOR_YELLOW = "\033[93m"
+COLOR_RED = "\033[91m"
+COLOR_RESET = "\033[0m"
 
 # --- LaTeX模板与AI指令 ---
 LATEX_PREAMBLE = r"""
@@ -135,6 +206,230 @@ B. 【组件化排版系统】(The Component System)
 现在，请严格遵循以上所有规则，特别是关于组件化系统的各项规定，开始你的工作。你的目标是生成一份单个的、完整的、能够完美编译的LaTeX文档正文。
 """
 
+# --- 编译工作区（内存盘） ---
+
+def directory_size(path):
+    """统计目录下所有文件的总字节数。文件可能正被其他进程删除，忽略这类竞争。"""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+def list_compile_workspaces():
+    """列出工作区根目录下所有由本脚本创建的工作区（带有预留标记文件的子目录）。"""
+    if COMPILE_WORKSPACE_ROOT is None or not COMPILE_WORKSPACE_ROOT.exists():
+        return []
+    return [ws for ws in COMPILE_WORKSPACE_ROOT.iterdir() if (ws / WORKSPACE_RESERVATION_FILE).exists()]
+
+def compile_workspace_usage():
+    """当前所有工作区的内存占用：每个工作区取“实际大小”与“预留大小”中的较大值。"""
+    usage = 0
+    for ws in list_compile_workspaces():
+        try:
+            reserved = int((ws / WORKSPACE_RESERVATION_FILE).read_text())
+        except (OSError, ValueError):
+            reserved = 0
+        usage += max(directory_size(ws), reserved)
+    return usage
+
+def acquire_compile_workspace(task_id, estimate_bytes, lock, log):
+    """
+    在内存盘上为本次编译创建一个工作区。
+    如果所有工作区的总占用加上本次预估会超出预算，就等待其他编译释放空间。
+    当前没有任何工作区时总是放行，保证超大的任务也能执行。
+    """
+    waiting_logged = False
+    while True:
+        with lock:
+            usage = compile_workspace_usage()
+            if usage == 0 or usage + estimate_bytes <= COMPILE_WORKSPACE_BUDGET:
+                workspace = COMPILE_WORKSPACE_ROOT / f"{os.getpid()}_{task_id}"
+                if workspace.exists():
+                    shutil.rmtree(workspace)
+                workspace.mkdir(parents=True)
+                (workspace / WORKSPACE_RESERVATION_FILE).write_text(str(estimate_bytes))
+                return workspace
+        if not waiting_logged:
+            log.info(f"[{task_id}] 编译工作区内存预算已满 ({usage / 1024**2:.0f}MB)，等待空间释放...")
+            waiting_logged = True
+        time.sleep(COMPILE_WORKSPACE_POLL_INTERVAL)
+
+def release_compile_workspace(workspace):
+    """删除工作区，归还内存预算。"""
+    shutil.rmtree(workspace, ignore_errors=True)
+
+def cleanup_process_workspaces(pid):
+    """删除某个（可能已崩溃的）工作进程遗留的所有工作区。"""
+    for ws in list_compile_workspaces():
+        if ws.name.startswith(f"{pid}_"):
+            release_compile_workspace(ws)
+
+def collect_stale_workspaces():
+    """启动时回收上次运行中崩溃进程遗留的工作区，返回回收的个数。"""
+    stale = list_compile_workspaces()
+    for ws in stale:
+        release_compile_workspace(ws)
+    return len(stale)
+
+# --- Token与配额记账 ---
+
+def new_usage():
+    """
+    一份用量统计：输入/输出token、生成请求数和尝试次数。
+    metered_requests 只统计带回了 usage_metadata 的请求，用来估算每次请求的token数。
+    """
+    return {'input_tokens': 0, 'output_tokens': 0, 'requests': 0, 'metered_requests': 0, 'attempts': 0}
+
+def add_usage(usage, attempt_stats):
+    """把一次尝试的用量累加到统计中。"""
+    usage['input_tokens'] += attempt_stats.get('input_tokens', 0)
+    usage['output_tokens'] += attempt_stats.get('output_tokens', 0)
+    usage['requests'] += attempt_stats.get('requests', 0)
+    usage['metered_requests'] += attempt_stats.get('metered_requests', 0)
+    usage['attempts'] += 1
+
+def usage_tokens(usage):
+    """输入与输出token之和。"""
+    return usage['input_tokens'] + usage['output_tokens']
+
+def record_response_usage(response, attempt_stats):
+    """从Gemini响应的 usage_metadata 中读取token用量。思考token按输出计费，计入输出。"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    attempt_stats['metered_requests'] = attempt_stats.get('metered_requests', 0) + 1
+    attempt_stats['input_tokens'] = getattr(usage, 'prompt_token_count', 0) or 0
+    attempt_stats['output_tokens'] = (getattr(usage, 'candidates_token_count', 0) or 0) + \
+                                     (getattr(usage, 'thoughts_token_count', 0) or 0)
+
+def quota_day(now):
+    """配额按 QUOTA_RESET_TIMEZONE 时区的自然日重置，返回当前配额日。"""
+    return datetime.datetime.fromtimestamp(now, zoneinfo.ZoneInfo(QUOTA_RESET_TIMEZONE)).strftime("%Y-%m-%d")
+
+def read_quota_ledger_file():
+    """读取台账文件，返回 {'day', 'keys'}；文件不存在或已损坏时返回None。"""
+    try:
+        with open(QUOTA_LEDGER_PATH, encoding="utf-8") as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stored, dict) or 'day' not in stored:
+        return None
+    # 旧版本写入的台账缺少后来新增的字段，补齐默认值
+    keys = {key: dict(new_usage(), **usage) for key, usage in stored.get('keys', {}).items()}
+    return {'day': stored['day'], 'keys': keys}
+
+def acquire_quota_ledger_lock():
+    """
+    对台账锁文件加独占锁（Windows用msvcrt，其他系统用fcntl），返回打开的锁文件。
+    锁由操作系统持有，进程崩溃时自动释放，不存在需要清理的遗留锁。
+    """
+    lock_file = open(QUOTA_LEDGER_LOCK_PATH, "a+b")
+    if os.name == 'nt':
+        # msvcrt 的阻塞模式最多只重试10秒，这里改为自己轮询
+        while True:
+            try:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                time.sleep(0.05)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    return lock_file
+
+def release_quota_ledger_lock(lock_file):
+    """释放台账锁并关闭锁文件。"""
+    if os.name == 'nt':
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    lock_file.close()
+
+def load_quota_ledger(now):
+    """
+    读取配额台账。台账跨运行保留，配额日变化后自动清零。
+    keys 是当天所有进程（包括另一个脚本）的累计用量，pending 是本进程还没写入文件的增量。
+    """
+    stored = read_quota_ledger_file()
+    keys = stored['keys'] if stored and stored['day'] == quota_day(now) else {}
+    return {'day': quota_day(now), 'keys': keys, 'pending': {}}
+
+def roll_quota_ledger(ledger, now):
+    """跨过配额重置时刻时清空台账。返回True表示发生了重置。"""
+    if ledger['day'] == quota_day(now):
+        return False
+    ledger['day'] = quota_day(now)
+    ledger['keys'] = {}
+    ledger['pending'] = {}
+    return True
+
+def save_quota_ledger(ledger):
+    """
+    把本进程的用量增量合并进台账文件。两个脚本可能同时运行，所以在文件锁内重新读取文件、
+    只累加增量，而不是用内存中的副本整体覆盖；合并结果同时刷新内存中的台账，让准入控制
+    也能看到另一个脚本的用量。先写临时文件再替换，避免中途崩溃留下损坏的台账。
+    """
+    QUOTA_LEDGER_PATH.parent.mkdir(parents=True, exist_ok=True)
+    lock_file = acquire_quota_ledger_lock()
+    try:
+        stored = read_quota_ledger_file()
+        if stored and stored['day'] > ledger['day']:
+            # 另一个进程已经进入新的配额日，本进程的增量属于已经过去的一天，不再写入
+            ledger['pending'] = {}
+            return
+        keys = stored['keys'] if stored and stored['day'] == ledger['day'] else {}
+        for key, delta in ledger['pending'].items():
+            usage = keys.setdefault(key, new_usage())
+            for field in usage:
+                usage[field] += delta[field]
+        temp_path = QUOTA_LEDGER_PATH.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({'day': ledger['day'], 'keys': keys}, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, QUOTA_LEDGER_PATH)
+    finally:
+        release_quota_ledger_lock(lock_file)
+    ledger['keys'] = keys
+    ledger['pending'] = {}
+
+def record_quota_usage(ledger, api_key, attempt_stats):
+    """把一次尝试的用量记入当天台账，同时记为待写入文件的增量。"""
+    add_usage(ledger['keys'].setdefault(api_key[-4:], new_usage()), attempt_stats)
+    add_usage(ledger['pending'].setdefault(api_key[-4:], new_usage()), attempt_stats)
+
+def estimated_tokens_per_request(usage):
+    """
+    按已有用量估算每次生成请求的token数；还没有数据时使用 ESTIMATED_TOKENS_PER_REQUEST。
+    只用带回了用量的请求做分母：429等报错的请求不返回token数，如果也算进去，配额错误越多估计值
+    反而越低，准入控制就会放行更多任务。
+    """
+    if usage['metered_requests'] == 0:
+        return ESTIMATED_TOKENS_PER_REQUEST
+    return usage_tokens(usage) / usage['metered_requests']
+
+def within_quota_budget(ledger, api_key, key_in_flight, total_in_flight, estimate_tokens):
+    """
+    准入控制：该Key和全局的“今日已用量 + 在途任务的预估用量 + 本次预估”都不能超过预算，
+    这样在配额真正耗尽之前就停止派发，而不是等API报错。
+    """
+    key_usage = ledger['keys'].get(api_key[-4:], new_usage())
+    total = new_usage()
+    for usage in ledger['keys'].values():
+        for field in total:
+            total[field] += usage.get(field, 0)
+    checks = [
+        (DAILY_TOKEN_BUDGET_PER_KEY, usage_tokens(key_usage) + (key_in_flight + 1) * estimate_tokens),
+        (DAILY_REQUEST_BUDGET_PER_KEY, key_usage['requests'] + key_in_flight + 1),
+        (DAILY_TOKEN_BUDGET_TOTAL, usage_tokens(total) + (total_in_flight + 1) * estimate_tokens),
+        (DAILY_REQUEST_BUDGET_TOTAL, total['requests'] + total_in_flight + 1),
+    ]
+    return all(budget is None or needed <= budget for budget, needed in checks)
+
 # --- 核心业务逻辑 ---
 def get_all_tasks():
     """生成所有可能任务的列表。"""
@@ -153,13 +448,18 @@ def get_all_tasks():
             tasks.append(("2025", "2BC", str(q_num), doc_type))
     return tasks
 
-def process_and_render_question(year, exam_type, question_num, doc_type, lock, output_dir_override=None):
+def process_and_render_question(year, exam_type, question_num, doc_type, lock, output_dir_override=None, xelatex_log_path=None, attempt_stats=None):
     """
     处理单个试题的核心函数。
     增加 output_dir_override 参数，允许在指定的临时目录中进行操作。
+    XeLaTeX的终端输出会流式写入 xelatex_log_path（默认写在输出目录中）。
+    本次尝试的请求数与token用量写入 attempt_stats。
     """
+    if attempt_stats is None:
+        attempt_stats = {}
     question_base_name = f"{year}-{exam_type}_第{question_num}問_{doc_type}"
     task_id = question_base_name 
+    log = logging.LoggerAdapter(logging.getLogger("worker"), {'task_id': task_id})
     
     question_output_dir = output_dir_override if output_dir_override else OUTPUT_DIR / question_base_name
     question_output_dir.mkdir(exist_ok=True)
@@ -169,7 +469,7 @@ def process_and_render_question(year, exam_type, question_num, doc_type, lock, o
     source_image_dir = source_folder_path / "images"
 
     if not source_pdf_path.exists():
-        print(f"注意: 源PDF文件未找到，跳过任务 -> {source_pdf_path}", flush=True)
+        log.warning(f"注意: 源PDF文件未找到，跳过任务 -> {source_pdf_path}")
         return True 
 
     try:
@@ -182,67 +482,186 @@ def process_and_render_question(year, exam_type, question_num, doc_type, lock, o
                 prompt_parts.append(image_list_prompt)
                 for image_path in image_files:
                     prompt_parts.append(genai.upload_file(path=image_path))
-        print(f"[{task_id}] 正在调用Gemini模型...", flush=True)
+        log.info(f"[{task_id}] 正在调用Gemini模型...")
         model = genai.GenerativeModel(model_name="gemini-2.5-pro")
+        # 请求一旦发出就计入配额，即使随后失败
+        attempt_stats['requests'] = attempt_stats.get('requests', 0) + 1
         response = model.generate_content(prompt_parts, request_options={"timeout": 600})
+        record_response_usage(response, attempt_stats)
         raw_text = response.text.strip()
         if raw_text.startswith("```latex"): raw_text = raw_text[len("```latex"):].strip()
         if raw_text.endswith("```"): raw_text = raw_text[:-len("```")].strip()
         final_latex_code = LATEX_PREAMBLE + "\n" + raw_text
         output_tex_path = question_output_dir / "generated.tex"
         with open(output_tex_path, "w", encoding="utf-8") as f: f.write(final_latex_code)
-        print(f"[{task_id}] LaTeX代码已保存到: {output_tex_path}", flush=True)
-        if source_folder_path.exists() and source_image_dir.exists() and any(source_image_dir.iterdir()):
-            target_image_dir = question_output_dir / "images"
-            if target_image_dir.exists(): shutil.rmtree(target_image_dir)
-            shutil.copytree(source_image_dir, target_image_dir)
-        print(f"[{task_id}] 开始自动渲染PDF...", flush=True)
-        for i in range(2):
-            process = subprocess.run(["xelatex", "-interaction=nonstopmode", output_tex_path.name], cwd=question_output_dir, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-            if process.returncode != 0:
-                print(f"\033[91m[{task_id}] 错误: XeLaTeX 编译失败！日志见: {output_tex_path.with_suffix('.log')}\033[0m", flush=True)
+        log.info(f"[{task_id}] LaTeX代码已保存到: {output_tex_path}")
+        has_images = source_folder_path.exists() and source_image_dir.exists() and any(source_image_dir.iterdir())
+        if COMPILE_WORKSPACE_ROOT is not None:
+            estimate_bytes = (directory_size(source_image_dir) if has_images else 0) + COMPILE_WORKSPACE_OVERHEAD
+            compile_dir = acquire_compile_workspace(task_id, estimate_bytes, lock, log)
+            shutil.copy(output_tex_path, compile_dir)
+        else:
+            compile_dir = question_output_dir
+        try:
+            if has_images:
+                target_image_dir = compile_dir / "images"
+                if target_image_dir.exists(): shutil.rmtree(target_image_dir)
+                shutil.copytree(source_image_dir, target_image_dir)
+            log.info(f"[{task_id}] 开始自动渲染PDF...")
+            if xelatex_log_path is None:
+                xelatex_log_path = question_output_dir / "xelatex_output.log"
+            for i in range(2):
+                with open(xelatex_log_path, "ab") as xelatex_log:
+                    process = subprocess.run(["xelatex", "-interaction=nonstopmode", output_tex_path.name], cwd=compile_dir, stdin=subprocess.DEVNULL, stdout=xelatex_log, stderr=subprocess.STDOUT)
+                if process.returncode != 0:
+                    log.error(f"[{task_id}] 错误: XeLaTeX 编译失败！日志见: {xelatex_log_path}")
+                    return False
+            compiled_pdf_path = compile_dir / output_tex_path.with_suffix('.pdf').name
+            if not compiled_pdf_path.exists():
+                log.error(f"[{task_id}] 错误: PDF文件未生成，即使编译命令没有报错。")
                 return False
-        if output_tex_path.with_suffix('.pdf').exists():
+            if compile_dir != question_output_dir:
+                shutil.copy(compiled_pdf_path, question_output_dir)
             try:
                 shutil.copy(source_pdf_path, question_output_dir)
             except Exception as copy_e:
-                print(f"\033[93m[{task_id}] 警告: 成功渲染PDF，但复制原始PDF失败: {copy_e}\033[0m", flush=True)
+                log.warning(f"[{task_id}] 警告: 成功渲染PDF，但复制原始PDF失败: {copy_e}")
             return True
-        else:
-            print(f"\033[91m[{task_id}] 错误: PDF文件未生成，即使编译命令没有报错。\033[0m", flush=True)
-            return False
+        finally:
+            if compile_dir != question_output_dir:
+                release_compile_workspace(compile_dir)
     except Exception as e:
-        print(f"\033[91m--- [{task_id}] 处理过程中发生严重错误: {e} ---\033[0m", flush=True)
+        log.error(f"--- [{task_id}] 处理过程中发生严重错误: {e} ---")
         raise
 
+# --- 集中式日志管线 ---
+
+class ConsoleFormatter(logging.Formatter):
+    """终端格式：按日志级别（或记录自带的color字段）上色。"""
+    LEVEL_COLORS = {logging.WARNING: COLOR_YELLOW, logging.ERROR: COLOR_RED, logging.CRITICAL: COLOR_RED}
+
+    def format(self, record):
+        message = super().format(record)
+        color = getattr(record, 'color', None) or self.LEVEL_COLORS.get(record.levelno)
+        return f"{color}{message}{COLOR_RESET}" if color else message
+
+class TaskFileHandler(logging.Handler):
+    """
+    按记录中的task_id把日志分发到每个任务自己的滚动日志文件。
+    最多同时打开 TASK_LOG_MAX_OPEN_FILES 个文件，按最近写入的顺序淘汰。
+    """
+
+    def __init__(self, task_log_dir):
+        super().__init__()
+        self.task_log_dir = task_log_dir
+        self.task_handlers = collections.OrderedDict()
+
+    def emit(self, record):
+        task_id = getattr(record, 'task_id', None)
+        if task_id is None:
+            return
+        handler = self.task_handlers.get(task_id)
+        if handler is None:
+            while len(self.task_handlers) >= TASK_LOG_MAX_OPEN_FILES:
+                _, oldest = self.task_handlers.popitem(last=False)
+                oldest.close()
+            handler = logging.handlers.RotatingFileHandler(
+                self.task_log_dir / f"{task_id}.log", maxBytes=TASK_LOG_MAX_BYTES,
+                backupCount=TASK_LOG_BACKUP_COUNT, encoding="utf-8")
+            handler.setFormatter(self.formatter)
+            self.task_handlers[task_id] = handler
+        else:
+            self.task_handlers.move_to_end(task_id)
+        handler.emit(record)
+
+    def close(self):
+        for handler in self.task_handlers.values():
+            handler.close()
+        self.task_handlers.clear()
+        super().close()
+
+def is_console_record(record):
+    """终端只显示主进程的事件，以及所有进程的警告和错误。"""
+    return record.name == "scheduler" or record.levelno >= logging.WARNING
+
+def start_log_pipeline(run_log_dir):
+    """在主进程中启动唯一的日志写入线程，返回 (log_queue, listener)。"""
+    task_log_dir = run_log_dir / "tasks"
+    task_log_dir.mkdir(exist_ok=True, parents=True)
+    file_formatter = logging.Formatter("%(asctime)s %(levelname)-7s [%(processName)s %(process)d] %(message)s")
+
+    run_handler = logging.handlers.RotatingFileHandler(
+        run_log_dir / "run.log", maxBytes=RUN_LOG_MAX_BYTES, backupCount=RUN_LOG_BACKUP_COUNT, encoding="utf-8")
+    run_handler.setFormatter(file_formatter)
+    task_handler = TaskFileHandler(task_log_dir)
+    task_handler.setFormatter(file_formatter)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    console_handler.addFilter(is_console_record)
+    console_handler.setFormatter(ConsoleFormatter("%(message)s"))
+
+    log_queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, run_handler, task_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    setup_process_logging(log_queue)
+    return log_queue, listener
+
+def setup_process_logging(log_queue):
+    """让当前进程的所有日志都只投递到队列中。"""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.DEBUG)
+
 # --- 饱和式攻击模式的Worker ---
 
-def assault_worker(task_info, api_key, lock, success_event):
+def select_assault_keys(ledger, estimate_tokens):
+    """配额准入：每个Key派出一个进程，依次挑出把已选Key的预估用量计入后仍有预算的Key。"""
+    keys = []
+    for api_key in API_KEYS:
+        if within_quota_budget(ledger, api_key, 0, len(keys), estimate_tokens):
+            keys.append(api_key)
+    return keys
+
+def assault_worker(task_info, api_key, lock, success_event, log_queue, run_log_dir, usage_queue):
     """
     “攻坚小组”的单个成员。
     在隔离的环境中工作，并持续检查全局成功信号。
+    结束时把本次尝试的结果（winner/loser/failed）和token用量放入 usage_queue。
     """
+    setup_process_logging(log_queue)
     pid = os.getpid()
     year, exam_type, q_num, doc_type = task_info
     task_id = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
+    log = logging.LoggerAdapter(logging.getLogger("worker"), {'task_id': task_id})
+    # 每个攻坚进程单独一个XeLaTeX输出文件，避免多个进程交错写入
+    xelatex_log_path = run_log_dir / "tasks" / f"{task_id}.{pid}.xelatex.log"
     
     base_output_dir = OUTPUT_DIR / task_id
     temp_output_dir = base_output_dir / f"temp_worker_{pid}"
     temp_output_dir.mkdir(exist_ok=True, parents=True)
     
-    print(f"[攻坚进程 {pid} | Key ...{api_key[-4:]}] 已启动，目标: {task_id}，工作区: {temp_output_dir}")
+    log.info(f"[攻坚进程 {pid} | Key ...{api_key[-4:]}] 已启动，目标: {task_id}，工作区: {temp_output_dir}")
 
+    attempt_stats = {}
+    outcome = None  # 提前退出时没有发出请求，不上报用量
     try:
         if success_event.is_set():
-            print(f"[攻坚进程 {pid}] 检测到任务已由其他进程完成，提前退出。")
+            log.info(f"[攻坚进程 {pid}] 检测到任务已由其他进程完成，提前退出。")
             return
 
         genai.configure(api_key=api_key)
-        success = process_and_render_question(year, exam_type, q_num, doc_type, lock, output_dir_override=temp_output_dir)
+        outcome = 'failed'
+        success = process_and_render_question(year, exam_type, q_num, doc_type, lock, output_dir_override=temp_output_dir, xelatex_log_path=xelatex_log_path, attempt_stats=attempt_stats)
 
         with lock:
-            if success and not success_event.is_set():
-                print(f"\033[92m[攻坚进程 {pid} | Key ...{api_key[-4:]}] 攻坚成功！我是胜利者！正在移交成果...\033[0m")
+            if success and success_event.is_set():
+                # 成果有效但晚了一步，这次尝试的用量同样算作浪费
+                outcome = 'loser'
+            elif success:
+                outcome = 'winner'
+                log.info(f"[攻坚进程 {pid} | Key ...{api_key[-4:]}] 攻坚成功！我是胜利者！正在移交成果...")
                 success_event.set()
                 
                 for item in temp_output_dir.iterdir():
@@ -253,87 +672,183 @@ def assault_worker(task_info, api_key, lock, success_event):
                         else:
                             target_path.unlink()
                     shutil.move(str(item), str(base_output_dir))
-                print(f"\033[92m[攻坚进程 {pid}] 成果已移交至: {base_output_dir}\033[0m")
+                log.info(f"[攻坚进程 {pid}] 成果已移交至: {base_output_dir}")
 
     except Exception as e:
-        print(f"\033[91m[攻坚进程 {pid} | Key ...{api_key[-4:]}] 遭遇严重错误: {e}\033[0m")
+        log.error(f"[攻坚进程 {pid} | Key ...{api_key[-4:]}] 遭遇严重错误: {e}")
     finally:
+        if outcome is not None:
+            usage_queue.put((api_key, outcome, attempt_stats))
         if temp_output_dir.exists():
             shutil.rmtree(temp_output_dir)
-        print(f"[攻坚进程 {pid}] 清理并退出。")
+        log.info(f"[攻坚进程 {pid}] 清理并退出。")
 
 
 if __name__ == "__main__":
     multiprocessing.set_start_method('spawn', force=True)
 
-    # 步骤 1: 准备需要“攻坚”的任务列表
-    print("\n--- 正在准备需要攻坚的任务列表 (基于'已复制的源PDF'进行检测) ---")
-    all_possible_tasks = get_all_tasks()
-    tasks_to_run = []
-    completed_count = 0
-    for task in all_possible_tasks:
-        year, exam_type, q_num, doc_type = task
-        task_id_as_dir_name = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
-        source_pdf_filename = f"{task_id_as_dir_name}.pdf"
-        expected_success_marker_path = OUTPUT_DIR / task_id_as_dir_name / source_pdf_filename
-        if expected_success_marker_path.exists() and expected_success_marker_path.is_file():
-            completed_count += 1
-        else:
-            tasks_to_run.append(task)
+    run_log_dir = LOG_DIR / time.strftime("%Y%m%d_%H%M%S")
+    log_queue, log_listener = start_log_pipeline(run_log_dir)
+    logger = logging.getLogger("scheduler")
+
+    # 无论正常结束、Ctrl-C还是异常退出，都要停止日志线程，把队列中剩余的日志（包括最后的错误）写完
+    try:
+        if COMPILE_WORKSPACE_ROOT is not None:
+            COMPILE_WORKSPACE_ROOT.mkdir(parents=True, exist_ok=True)
+            stale_count = collect_stale_workspaces()
+            logger.info(f"编译工作区: {COMPILE_WORKSPACE_ROOT} (预算 {COMPILE_WORKSPACE_BUDGET / 1024**2:.0f}MB)，已回收 {stale_count} 个遗留工作区。")
+
+        # 步骤 1: 准备需要“攻坚”的任务列表
+        logger.info("\n--- 正在准备需要攻坚的任务列表 (基于'已复制的源PDF'进行检测) ---")
+        all_possible_tasks = get_all_tasks()
+        tasks_to_run = []
+        completed_count = 0
+        for task in all_possible_tasks:
+            year, exam_type, q_num, doc_type = task
+            task_id_as_dir_name = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
+            source_pdf_filename = f"{task_id_as_dir_name}.pdf"
+            expected_success_marker_path = OUTPUT_DIR / task_id_as_dir_name / source_pdf_filename
+            if expected_success_marker_path.exists() and expected_success_marker_path.is_file():
+                completed_count += 1
+            else:
+                tasks_to_run.append(task)
             
-    if not tasks_to_run:
-        print(f"\033[92m所有任务均已完全成功，无需执行新任务。\033[0m")
-        sys.exit(0)
+        if not tasks_to_run:
+            logger.info("所有任务均已完全成功，无需执行新任务。", extra={'color': COLOR_GREEN})
+            sys.exit(0)
         
-    print(f"总计发现 {len(all_possible_tasks)} 个任务，其中 {completed_count} 个已完全成功。")
-    print(f"本次需要攻坚 {len(tasks_to_run)} 个任务。")
+        logger.info(f"总计发现 {len(all_possible_tasks)} 个任务，其中 {completed_count} 个已完全成功。")
+        logger.info(f"本次需要攻坚 {len(tasks_to_run)} 个任务。日志目录: {run_log_dir}")
 
-    # 步骤 2: 逐个任务进行饱和式攻击
-    successful_assaults = []
-    failed_assaults = []
+        # 步骤 2: 逐个任务进行饱和式攻击
+        successful_assaults = []
+        failed_assaults = []
+        # Token用量：按Key、按任务、整次运行，以及浪费在落败（成功但晚了一步）和失败尝试上的部分
+        key_usage = collections.defaultdict(new_usage)
+        task_usage = collections.defaultdict(new_usage)
+        run_usage = new_usage()
+        wasted_usage = {'loser': new_usage(), 'failed': new_usage()}
+        # 跨运行的当日配额台账
+        quota_ledger = load_quota_ledger(time.time())
+        # 因配额不足而留到下次运行的任务
+        deferred_tasks = []
     
-    for i, task_info in enumerate(tasks_to_run):
-        year, exam_type, q_num, doc_type = task_info
-        task_id = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
+        for i, task_info in enumerate(tasks_to_run):
+            year, exam_type, q_num, doc_type = task_info
+            task_id = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
         
-        print("\n" + "="*80)
-        print(f"  开始对任务 {i+1}/{len(tasks_to_run)} 进行饱和式攻击: 【{task_id}】")
-        print("="*80)
+            logger.info("\n" + "="*80)
+            logger.info(f"  开始对任务 {i+1}/{len(tasks_to_run)} 进行饱和式攻击: 【{task_id}】")
+            logger.info("="*80)
+
+            # 配额准入：只有今日预算还能覆盖一次尝试的Key才参战
+            if roll_quota_ledger(quota_ledger, time.time()):
+                save_quota_ledger(quota_ledger)
+                logger.info(f"[配额] 已进入新的配额日 {quota_ledger['day']}，每日用量清零。", extra={'color': COLOR_GREEN})
+            assault_keys = select_assault_keys(quota_ledger, estimated_tokens_per_request(run_usage))
+            if not assault_keys and QUOTA_WAIT_FOR_RESET:
+                logger.warning(f"[配额] 今日预算已用尽，暂停攻坚，等待配额重置 (配额日 {quota_ledger['day']})。")
+                while not assault_keys:
+                    time.sleep(QUOTA_PAUSE_INTERVAL)
+                    if roll_quota_ledger(quota_ledger, time.time()):
+                        save_quota_ledger(quota_ledger)
+                        logger.info(f"[配额] 已进入新的配额日 {quota_ledger['day']}，每日用量清零。", extra={'color': COLOR_GREEN})
+                        assault_keys = select_assault_keys(quota_ledger, estimated_tokens_per_request(run_usage))
+            if not assault_keys:
+                logger.warning(f"[配额] 今日预算已用尽，停止攻坚；剩余 {len(tasks_to_run) - i} 个任务留待下次运行。")
+                for year, exam_type, q_num, doc_type in tasks_to_run[i:]:
+                    deferred_tasks.append(f"{year}-{exam_type}_第{q_num}問_{doc_type}")
+                break
+            if len(assault_keys) < len(API_KEYS):
+                logger.info(f"[配额] 本轮只有 {len(assault_keys)}/{len(API_KEYS)} 个Key仍有预算，参与攻坚。")
 
-        manager = multiprocessing.Manager()
-        success_event = manager.Event()
-        lock = manager.Lock()
+            manager = multiprocessing.Manager()
+            success_event = manager.Event()
+            lock = manager.Lock()
+            usage_queue = manager.Queue()
         
-        processes = []
-        for api_key in API_KEYS:
-            p = multiprocessing.Process(target=assault_worker, args=(task_info, api_key, lock, success_event))
-            p.start()
-            processes.append(p)
+            processes = []
+            for api_key in assault_keys:
+                p = multiprocessing.Process(target=assault_worker, args=(task_info, api_key, lock, success_event, log_queue, run_log_dir, usage_queue))
+                p.start()
+                processes.append(p)
             
-        for p in processes:
-            p.join()
+            for p in processes:
+                p.join()
+                if COMPILE_WORKSPACE_ROOT is not None:
+                    cleanup_process_workspaces(p.pid)
 
-        # 步骤 3: 战果评估
-        task_id_as_dir_name = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
-        source_pdf_filename = f"{task_id_as_dir_name}.pdf"
-        expected_success_marker_path = OUTPUT_DIR / task_id_as_dir_name / source_pdf_filename
+            # Token记账：所有进程都已退出，收集每个Key本轮的用量
+            while True:
+                try:
+                    api_key, outcome, attempt_stats = usage_queue.get_nowait()
+                except queue.Empty:
+                    break
+                add_usage(key_usage[api_key], attempt_stats)
+                add_usage(task_usage[task_id], attempt_stats)
+                add_usage(run_usage, attempt_stats)
+                if outcome != 'winner':
+                    add_usage(wasted_usage[outcome], attempt_stats)
+                record_quota_usage(quota_ledger, api_key, attempt_stats)
+            save_quota_ledger(quota_ledger)
+            task_tokens = usage_tokens(task_usage[task_id])
+            logger.info(f"[用量] 任务 【{task_id}】 本轮共消耗 {task_tokens} tokens, {task_usage[task_id]['requests']} 次请求。")
+
+            # 步骤 3: 战果评估
+            task_id_as_dir_name = f"{year}-{exam_type}_第{q_num}問_{doc_type}"
+            source_pdf_filename = f"{task_id_as_dir_name}.pdf"
+            expected_success_marker_path = OUTPUT_DIR / task_id_as_dir_name / source_pdf_filename
         
-        if expected_success_marker_path.exists():
-            print(f"\033[92m[战果评估] 任务 【{task_id}】 攻坚成功！\033[0m")
-            successful_assaults.append(task_id)
-        else:
-            print(f"\033[91m[战果评估] 任务 【{task_id}】 攻坚失败，所有API尝试均未成功。\033[0m")
-            failed_assaults.append(task_id)
-
-    # 步骤 4: 最终总结
-    print("\n" + "="*80)
-    print("           所有攻坚任务已结束 - 最终摘要")
-    print("="*80)
-    print(f"\033[92m成功攻克的任务数: {len(successful_assaults)}\033[0m")
-    print(f"\033[91m未能攻克的任务数: {len(failed_assaults)}\033[0m")
-    if failed_assaults:
-        print("\n未能攻克的任务列表:")
-        for task_id in failed_assaults:
-            print(f"  - {task_id}")
-    print("="*80)
-    print("\033[92m--- 程序执行结束 ---\033[0m")
+            if expected_success_marker_path.exists():
+                logger.info(f"[战果评估] 任务 【{task_id}】 攻坚成功！", extra={'color': COLOR_GREEN})
+                successful_assaults.append(task_id)
+            else:
+                logger.error(f"[战果评估] 任务 【{task_id}】 攻坚失败，所有API尝试均未成功。")
+                failed_assaults.append(task_id)
+
+        # 步骤 4: 最终总结
+        logger.info("\n" + "="*80)
+        logger.info("           所有攻坚任务已结束 - 最终摘要")
+        logger.info("="*80)
+        logger.info(f"成功攻克的任务数: {len(successful_assaults)}", extra={'color': COLOR_GREEN})
+        logger.info(f"未能攻克的任务数: {len(failed_assaults)}", extra={'color': COLOR_RED})
+        if failed_assaults:
+            logger.info("\n未能攻克的任务列表:")
+            for task_id in failed_assaults:
+                logger.info(f"  - {task_id}")
+        logger.info("\nToken与配额用量:")
+        for key in API_KEYS:
+            usage = key_usage[key]
+            today = quota_ledger['keys'].get(key[-4:], new_usage())
+            logger.info(f"  - Key ...{key[-4:]}: 输入 {usage['input_tokens']} / 输出 {usage['output_tokens']} tokens, 请求 {usage['requests']} 次 (今日累计 {usage_tokens(today)} tokens, {today['requests']} 次)")
+        total_tokens = usage_tokens(run_usage)
+        for outcome, label in (('loser', '落败尝试（成功但晚了一步）'), ('failed', '失败尝试')):
+            wasted_tokens = usage_tokens(wasted_usage[outcome])
+            wasted_ratio = wasted_tokens / total_tokens if total_tokens else 0.0
+            logger.info(f"  浪费在{label}上: {wasted_tokens} tokens ({wasted_ratio:.0%})")
+        logger.info(f"  本次合计: {total_tokens} tokens, {run_usage['requests']} 次请求")
+        if successful_assaults:
+            logger.info(f"  平均每个攻克的任务消耗 {total_tokens / len(successful_assaults):.0f} tokens")
+        if deferred_tasks:
+            logger.warning(f"  因配额不足留待下次运行的任务数: {len(deferred_tasks)}")
+        # 详细的用量报告（按任务、按Key）写入本次运行的日志目录
+        usage_report_path = run_log_dir / "usage_report.json"
+        with open(usage_report_path, "w", encoding="utf-8") as f:
+            json.dump({
+                'run': run_usage,
+                'wasted': wasted_usage,
+                'keys': {key[-4:]: key_usage[key] for key in API_KEYS},
+                'tasks': dict(sorted(task_usage.items())),
+                'deferred_tasks': deferred_tasks,
+                'quota_ledger': {'day': quota_ledger['day'], 'keys': quota_ledger['keys']},
+            }, f, ensure_ascii=False, indent=2)
+        logger.info(f"  详细用量报告: {usage_report_path}")
+        logger.info("="*80)
+        if deferred_tasks:
+            logger.warning(f"注意：有 {len(deferred_tasks)} 个任务因配额不足未执行，下次运行时会自动继续。")
+        logger.info("--- 程序执行结束 ---", extra={'color': COLOR_GREEN})
+    except KeyboardInterrupt:
+        logger.warning("收到中断信号 (Ctrl-C)，程序提前退出。")
+        raise
+    finally:
+        log_listener.stop()